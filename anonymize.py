@@ -1,24 +1,112 @@
+"""
+Anonymize user ids in the likes crawl by replacing them with a keyed HMAC.
+
+The file is streamed in chunks. Each distinct uid is hashed once and then
+served from a bounded LRU cache, since heavy users show up thousands of
+times. Chunks can be spread over a process pool; output order always matches
+the input.
+"""
+
 import argparse
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 import csv
+from functools import lru_cache
+import hashlib
 import hmac
+from itertools import islice
+import time
 
-if __name__ == '__main__':
-    parser = argparse.ArgumentParser(description='Anonymize user ids')
-    parser.add_argument('urls', help='Output of crawl.py --type urls')
-    parser.add_argument('anonymized', help='Anonymized output filename')
-    parser.add_argument('key', help='Secret key for hashing of user ids')
 
-    args = parser.parse_args()
-    with open(args.urls, 'r') as fin:
-        with open(args.anonymized, 'w') as fout:
+def make_hasher(key, digest, cache_size):
+    """Memoized HMAC of a uid under key."""
+    @lru_cache(maxsize=cache_size)
+    def hash_uid(uid):
+        return hmac.new(key, bytes(uid, 'utf-8'), digest).hexdigest()
+    return hash_uid
+
+
+def _init_worker(key, digest, cache_size):
+    global HASH_UID
+    HASH_UID = make_hasher(key, digest, cache_size)
+
+
+def anonymize_chunk(rows, hash_uid=None):
+    """Drop user names and hash uids for a list of likes rows."""
+    hash_uid = hash_uid or HASH_UID
+    # Throw away user name
+    return [[row[0], row[1], hash_uid(row[2])] for row in rows]
+
+
+def read_chunks(reader, chunk_size):
+    while True:
+        chunk = list(islice(reader, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def anonymized_chunks(chunks, key, digest, cache_size, workers):
+    """Anonymize chunks in order, in this process or on a process pool."""
+    if not workers:
+        hash_uid = make_hasher(key, digest, cache_size)
+        for chunk in chunks:
+            yield anonymize_chunk(chunk, hash_uid)
+        return
+
+    with ProcessPoolExecutor(max_workers=workers,
+                             initializer=_init_worker,
+                             initargs=(key, digest, cache_size)) as executor:
+        # Bound the chunks in flight so the file is never read into memory.
+        pending = deque()
+        for chunk in chunks:
+            pending.append(executor.submit(anonymize_chunk, chunk))
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def anonymize(likes_filename, anonymized_filename, key, digest='sha256',
+              chunk_size=100000, cache_size=2 ** 20, workers=None):
+    """Stream likes_filename to anonymized_filename. Returns rows written."""
+    if digest not in hashlib.algorithms_available:
+        raise ValueError('Unknown digest {}'.format(digest))
+    key = bytes(key, 'utf-8')
+    rows = 0
+    t0 = time.time()
+    with open(likes_filename, 'r', newline='') as fin:
+        with open(anonymized_filename, 'w', newline='') as fout:
             reader = csv.reader(fin, delimiter='|', quoting=csv.QUOTE_MINIMAL,
                                 quotechar='\\')
             writer = csv.writer(fout, delimiter='|', quoting=csv.QUOTE_MINIMAL,
                                 quotechar='\\')
             writer.writerow(['modelname', 'mid', 'uid'])
-            key = bytes(args.key, 'utf-8')
-            for row in reader:
-                # Throw away user name
-                modelname, mid, uid = row[0], row[1], row[2]
-                uid = hmac.new(key, bytes(uid, 'utf-8')).hexdigest()
-                writer.writerow([modelname, mid, uid])
+            chunks = read_chunks(reader, chunk_size)
+            for chunk in anonymized_chunks(chunks, key, digest, cache_size,
+                                           workers):
+                writer.writerows(chunk)
+                rows += len(chunk)
+                print('{} rows, {:.0f} rows/second'
+                      .format(rows, rows / (time.time() - t0)))
+    return rows
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Anonymize user ids')
+    parser.add_argument('urls', help='Output of crawl.py --type likes')
+    parser.add_argument('anonymized', help='Anonymized output filename')
+    parser.add_argument('key', help='Secret key for hashing of user ids')
+    parser.add_argument('--digest', default='sha256',
+                        help='HMAC digest. Python < 3.8 defaulted to md5.')
+    parser.add_argument('--chunk-size', default=100000, type=int)
+    parser.add_argument('--cache-size', default=2 ** 20, type=int,
+                        help='Number of distinct uids to memoize')
+    parser.add_argument('--workers', default=None, type=int,
+                        help='Processes to hash on. Default is in-process.')
+
+    args = parser.parse_args()
+    rows = anonymize(args.urls, args.anonymized, args.key, digest=args.digest,
+                     chunk_size=args.chunk_size, cache_size=args.cache_size,
+                     workers=args.workers)
+    print('Anonymized {} rows'.format(rows))
@@ -0,0 +1,159 @@
+"""
+Benchmark catalog discovery through the JSON listing against the Selenium
+crawler, replaying recorded pages from a local server.
+
+Record fixtures once (needs network access and chromedriver):
+
+    python benchmark_catalog.py config.yml record fixtures --like-limit 2000
+
+then replay them as often as needed:
+
+    python benchmark_catalog.py config.yml replay fixtures
+
+A high --like-limit keeps the fixtures down to a handful of pages.
+"""
+
+import argparse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+from urllib.parse import parse_qs, urlparse
+
+import crawl
+import fetch
+
+
+def record(fixtures_dir, chromedriver, like_limit):
+    """Save every API and html catalog page down to like_limit."""
+    for sub in ('api', 'html'):
+        os.makedirs(os.path.join(fixtures_dir, sub), exist_ok=True)
+    crawl.LIKE_LIMIT = like_limit
+
+    session = fetch.make_session(1)
+    url = crawl.CATALOG_API_URL
+    params = {'sort_by': '-likeCount', 'count': 24}
+    page = 1
+    while url:
+        response = fetch.get_json(session, url, params=params)
+        with open(os.path.join(fixtures_dir, 'api',
+                               'page_{}.json'.format(page)), 'w') as f:
+            json.dump(response, f)
+        params = None
+        url = response.get('next')
+        if any(r['likeCount'] < like_limit for r in response['results']):
+            url = None
+        page += 1
+
+    crawl.load_browser(chromedriver)
+    page = 1
+    end = False
+    while not end:
+        _, end = crawl.get_page_models(page)
+        with open(os.path.join(fixtures_dir, 'html',
+                               'page_{}.html'.format(page)), 'w') as f:
+            f.write(crawl.BROWSER.page_source)
+        page += 1
+    crawl.BROWSER.quit()
+
+    with open(os.path.join(fixtures_dir, 'meta.json'), 'w') as f:
+        json.dump({'like_limit': like_limit}, f)
+
+
+def serve(fixtures_dir):
+    """Serve recorded pages on a local port. Returns the server."""
+
+    class FixtureHandler(BaseHTTPRequestHandler):
+
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            page = int(parse_qs(url.query).get('page', ['1'])[0])
+            kind = 'api' if url.path == '/api' else 'html'
+            ext = 'json' if kind == 'api' else 'html'
+            filename = os.path.join(fixtures_dir, kind,
+                                    'page_{}.{}'.format(page, ext))
+            if not os.path.isfile(filename):
+                self.send_response(404)
+                self.end_headers()
+                return
+            with open(filename, 'r') as f:
+                body = f.read()
+            if kind == 'api':
+                # Point the cursor at the next recorded page.
+                body = json.loads(body)
+                following = os.path.join(fixtures_dir, 'api',
+                                         'page_{}.json'.format(page + 1))
+                body['next'] = ('http://{}:{}/api?page={}'.format(
+                    *self.server.server_address, page + 1)
+                    if os.path.isfile(following) else None)
+                body = json.dumps(body)
+            self.send_response(200)
+            self.end_headers()
+            self.wfile.write(body.encode('utf-8'))
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FixtureHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def count_rows(filename):
+    return len(crawl.read_catalog(filename))
+
+
+def replay(fixtures_dir, chromedriver, skip_browser=False):
+    with open(os.path.join(fixtures_dir, 'meta.json'), 'r') as f:
+        crawl.LIKE_LIMIT = json.load(f)['like_limit']
+    server = serve(fixtures_dir)
+    base = 'http://{}:{}'.format(*server.server_address)
+    crawl.CATALOG_API_URL = base + '/api'
+    crawl.PARENT_CATALOG_URL = base + '/models?sort_by=-likeCount&page='
+    tmp_dir = tempfile.mkdtemp()
+    results = []
+    try:
+        fileout = os.path.join(tmp_dir, 'api.psv')
+        t0 = time.time()
+        crawl.collect_model_urls_api(fileout, requests_per_second=0)
+        results.append(('json api', time.time() - t0, count_rows(fileout)))
+
+        if not skip_browser:
+            fileout = os.path.join(tmp_dir, 'browser.psv')
+            t0 = time.time()
+            crawl.collect_model_urls(fileout, chromedriver)
+            crawl.BROWSER.quit()
+            results.append(('selenium', time.time() - t0,
+                            count_rows(fileout)))
+    finally:
+        server.shutdown()
+        shutil.rmtree(tmp_dir)
+
+    print('{:>10} | {:>10} | {:>8}'.format('path', 'seconds', 'models'))
+    for (name, seconds, models) in results:
+        print('{:>10} | {:>10.2f} | {:>8}'.format(name, seconds, models))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Catalog crawl benchmark')
+    parser.add_argument('config', help='config file with DB and API params')
+    parser.add_argument('command', choices=['record', 'replay'])
+    parser.add_argument('fixtures', help='Directory of recorded pages')
+    parser.add_argument('--like-limit', default=None, type=int,
+                        help='LIKE_LIMIT to record with')
+    parser.add_argument('--skip-browser', action='store_true',
+                        help='Only replay the JSON api path')
+    args = parser.parse_args()
+
+    config = crawl.load_config(args.config)
+    if args.command == 'record':
+        record(args.fixtures, config['chromedriver'],
+               args.like_limit or crawl.LIKE_LIMIT)
+    else:
+        replay(args.fixtures, config['chromedriver'],
+               skip_browser=args.skip_browser)
@@ -0,0 +1,238 @@
+"""
+Item-to-item recommendations from the categories and tags of each model.
+
+The mid|type|value rows of the features crawl are turned into a sparse
+item x feature matrix. Categories and frequent tags get a column each; the
+long tail of rare tags is hashed into a fixed number of buckets so the
+vocabulary stays bounded. Features are TF-IDF weighted and neighbours are
+the top K by cosine similarity, computed in blocks on a process pool like
+similarity.py.
+
+Models with few likes get poor collaborative recommendations, so for those
+the content scores can be blended with the cosine similarity of their like
+vectors (--blend-below).
+"""
+
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import os
+import zlib
+
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+import yaml
+
+import helpers
+import storage
+from similarity import block_neighbours, block_similarity
+
+
+def load_features(filename):
+    """mid, type and value columns of the features crawl."""
+    feats = storage.read_table(filename, columns=['mid', 'type', 'value'])
+    return feats.dropna()
+
+
+def feature_matrix(feats, min_count=5, hash_buckets=2 ** 16, mids=None):
+    """
+    TF-IDF weighted item x feature matrix.
+
+    Parameters
+    ----------
+    feats : DataFrame
+        mid, type and value columns, as from load_features.
+    min_count : int
+        Tags on fewer models than this are hashed into buckets instead of
+        getting their own column. Categories always get their own column.
+    hash_buckets : int
+    mids : array, optional
+        Item index to use. Defaults to every mid in feats.
+
+    Returns
+    -------
+    item_features : sparse csr matrix
+        L2 normalized rows.
+    mids : array
+        Maps row index to mid.
+    """
+    keys = (feats['type'].astype(str) + ':'
+            + feats['value'].astype(str).str.strip().str.lower())
+    feats = pd.DataFrame({'mid': feats['mid'].values, 'key': keys.values})
+    feats = feats.drop_duplicates()
+    rows, mids = helpers.encode_ids(feats['mid'].values, ids=mids)
+    feats = feats[rows >= 0]
+    rows = rows[rows >= 0]
+
+    counts = feats['key'].map(feats['key'].value_counts())
+    is_tag = feats['key'].str.startswith('tag:')
+    rare = (is_tag & (counts < min_count)).values
+    cols = np.empty(feats.shape[0], dtype=np.int64)
+    cols[~rare], vocabulary = pd.factorize(feats['key'].values[~rare])
+    cols[rare] = len(vocabulary) + np.array(
+        [zlib.crc32(k.encode('utf-8')) % hash_buckets
+         for k in feats['key'].values[rare]], dtype=np.int64)
+
+    n_items = len(mids)
+    item_features = sp.csr_matrix(
+        (np.ones(len(rows)), (rows, cols)),
+        shape=(n_items, len(vocabulary) + hash_buckets))
+    # Duplicates within a hash bucket were summed; keep term presence only.
+    item_features.data[:] = 1.
+    doc_freq = np.bincount(item_features.indices,
+                           minlength=item_features.shape[1])
+    idf = np.log((1. + n_items) / (1. + doc_freq)) + 1.
+    item_features = item_features @ sp.diags(idf)
+    norms = np.sqrt(np.asarray(item_features.multiply(item_features)
+                               .sum(axis=1)).ravel())
+    norms[norms == 0] = 1.
+    item_features = sp.diags(1. / norms) @ item_features
+    print('{} models x {} features ({} tags hashed into {} buckets)'
+          .format(n_items, len(vocabulary) + hash_buckets,
+                  np.unique(feats['key'].values[rare]).shape[0],
+                  hash_buckets))
+    return item_features.tocsr(), mids
+
+
+def _init_worker(item_features, item_user, blend, content_weight, K):
+    """Store the read-only matrices once per worker process."""
+    global ITEM_FEATURE, FEATURE_ITEM, ITEM_USER, USER_ITEM, NORMS
+    global BLEND, CONTENT_WEIGHT, TOP_K
+    ITEM_FEATURE = item_features
+    FEATURE_ITEM = item_features.T.tocsr()
+    BLEND = blend
+    CONTENT_WEIGHT = content_weight
+    TOP_K = K
+    if item_user is not None:
+        ITEM_USER = item_user
+        USER_ITEM = item_user.T.tocsr()
+        NORMS = np.sqrt(np.asarray(item_user.multiply(item_user).sum(axis=1))
+                        .ravel())
+
+
+def block_scores(start, stop):
+    """Content similarity of items start:stop to every item, blended with
+    like similarity for the items in the block that are marked in BLEND."""
+    scores = (ITEM_FEATURE[start:stop] @ FEATURE_ITEM).toarray()
+    blend = BLEND[start:stop]
+    if blend.any():
+        likes = block_similarity(ITEM_USER, USER_ITEM, NORMS, 'cosine',
+                                 start, stop)
+        scores[blend] = (CONTENT_WEIGHT * scores[blend]
+                         + (1. - CONTENT_WEIGHT) * likes[blend])
+    return scores
+
+
+def _worker_block(start, stop):
+    return start, block_neighbours(block_scores(start, stop), start, TOP_K)
+
+
+def content_neighbours(item_features, K=20, item_user=None, like_counts=None,
+                       blend_below=0, content_weight=0.5, block_size=1024,
+                       workers=None):
+    """Top K most similar items for every item by content.
+
+    Parameters
+    ----------
+    item_features : sparse csr matrix
+        Item x feature matrix with L2 normalized rows.
+    K : int
+        Number of neighbours to keep per item.
+    item_user : sparse csr matrix, optional
+        Item x user likes on the same item index as item_features.
+    like_counts : array, optional
+        Likes per item. Items with fewer than blend_below likes score
+        neighbours by content_weight * content + (1 - content_weight) *
+        like cosine similarity.
+    blend_below : int
+    content_weight : float
+    block_size : int
+        Number of items scored per task.
+    workers : int, optional
+        Number of worker processes.
+
+    Returns
+    -------
+    neighbours : array of int32 (n_items x K)
+        Item indices, most similar first, padded with -1.
+    """
+    n_items = item_features.shape[0]
+    K = min(K, n_items - 1)
+    if item_user is not None and blend_below > 0:
+        blend = np.asarray(like_counts) < blend_below
+        print('Blending like similarity into {} models with fewer than {} '
+              'likes'.format(blend.sum(), blend_below))
+    else:
+        item_user = None
+        blend = np.zeros(n_items, dtype=bool)
+
+    neighbours = np.empty((n_items, K), dtype=np.int32)
+    with ProcessPoolExecutor(max_workers=workers,
+                             initializer=_init_worker,
+                             initargs=(item_features, item_user, blend,
+                                       content_weight, K)) as executor:
+        futures = [executor.submit(_worker_block, start,
+                                   min(start + block_size, n_items))
+                   for start in range(0, n_items, block_size)]
+        for future in futures:
+            start, block = future.result()
+            neighbours[start:start + block.shape[0]] = block
+    return neighbours
+
+
+def like_matrix(likes_filename, mids):
+    """Item x user likes on the item index mids, and likes per item."""
+    likes = helpers.load_likes(likes_filename)
+    likes = likes.drop_duplicates()
+    item_user, _, _ = helpers.df_to_matrix(likes, 'mid', 'uid', row_ids=mids,
+                                           as_dicts=False)
+    item_user = sp.csr_matrix(item_user, dtype=np.float64)
+    return item_user, np.diff(item_user.indptr)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Content recommendations from categories and tags')
+    parser.add_argument('config', help='config file with data locations')
+    parser.add_argument('--N', default=20, type=int,
+                        help='Number of recommendations per model')
+    parser.add_argument('--candidates', default=None, type=int,
+                        help='Candidates per model before dropping those '
+                             'without a thumbnail. Defaults to 3 * N.')
+    parser.add_argument('--min-count', default=5, type=int,
+                        help='Tags on fewer models are hashed')
+    parser.add_argument('--hash-buckets', default=2 ** 16, type=int)
+    parser.add_argument('--blend-below', default=0, type=int,
+                        help='Blend in like similarity for models with '
+                             'fewer likes than this')
+    parser.add_argument('--content-weight', default=0.5, type=float)
+    parser.add_argument('--block-size', default=1024, type=int)
+    parser.add_argument('--workers', default=None, type=int)
+    parser.add_argument('--output', default=None,
+                        help='Recs file. Defaults to the content file in '
+                             'config')
+
+    args = parser.parse_args()
+    config = yaml.safe_load(open(args.config, 'r'))
+    features_file = os.path.join(config['data_dir'],
+                                 config['data_files']['model_features_file'])
+    output = args.output or helpers.get_recs_filename(config, 'content')
+
+    item_features, mids = feature_matrix(load_features(features_file),
+                                         min_count=args.min_count,
+                                         hash_buckets=args.hash_buckets)
+    item_user, like_counts = None, None
+    if args.blend_below > 0:
+        likes_file = os.path.join(config['data_dir'],
+                                  config['data_files']['likes_file'])
+        item_user, like_counts = like_matrix(likes_file, mids)
+    neighbours = content_neighbours(item_features,
+                                    K=args.candidates or 3 * args.N,
+                                    item_user=item_user,
+                                    like_counts=like_counts,
+                                    blend_below=args.blend_below,
+                                    content_weight=args.content_weight,
+                                    block_size=args.block_size,
+                                    workers=args.workers)
+    helpers.export_recs(config, output, neighbours, mids, args.N)
+    print('Wrote recs to {}'.format(output))
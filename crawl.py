@@ -3,20 +3,24 @@ Functions for crawling Sketchfab to grab model names, likes, or tags.
 """
 
 import argparse
-from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import ThreadPoolExecutor
 import concurrent.futures
 from collections import namedtuple
 import csv
+from functools import partial
 import os
-import requests
+import queue
+import threading
 import time
-import urllib
 
 import pandas as pd
 from selenium import webdriver
+from selenium.webdriver.support.ui import WebDriverWait
 from six.moves import input
 import yaml
 
+import fetch
+
 def load_browser(chromedriver):
     """Start new global browser session"""
     global BROWSER
@@ -27,7 +31,7 @@ def load_config(filename):
     """
     Load relevant parts of configuration file into global variables
     """
-    config = yaml.load(open(filename, 'r'))
+    config = yaml.safe_load(open(filename, 'r'))
     os.environ['webdriver.chrome.driver'] = config['chromedriver']
     global PARENT_CATALOG_URL
     PARENT_CATALOG_URL = config['PARENT_CATALOG_URL']
@@ -37,10 +41,17 @@ def load_config(filename):
     BASE_LIKES_URL = config['BASE_LIKES_URL']
     global BASE_THUMBS_URL
     BASE_THUMBS_URL = config['BASE_THUMBS_URL']
+    global CATALOG_API_URL
+    CATALOG_API_URL = config.get('CATALOG_API_URL',
+                                 'https://api.sketchfab.com/v3/models')
     global LIKE_LIMIT
     LIKE_LIMIT = config['LIKE_LIMIT']
     global MAX_WORKERS
     MAX_WORKERS = config['MAX_WORKERS']
+    global CONCURRENCY
+    CONCURRENCY = config.get('CONCURRENCY', 16)
+    global REQUESTS_PER_SECOND
+    REQUESTS_PER_SECOND = config.get('REQUESTS_PER_SECOND', 10)
 
     return config
 
@@ -132,7 +143,81 @@ def collect_model_urls(fileout, chromedriver):
     print('All done.')
 
 
-def get_model_likes(mid, User, count=24):
+def get_catalog_page(session, url, params=None, limiter=None):
+    """
+    Fetch one page of the JSON model listing (sorted by most liked).
+
+    Returns
+    -------
+    models : list
+        Model(name, mid) tuples with at least LIKE_LIMIT likes.
+    next_url : str or None
+        Url of the following page.
+    end : bool
+        True once a model below LIKE_LIMIT shows up or pages run out.
+    """
+    Model = namedtuple('Model', ['name', 'mid'])
+    response = fetch.get_json(session, url, params=params, limiter=limiter)
+    models = []
+    end = False
+    for result in response['results']:
+        if result['likeCount'] < LIKE_LIMIT:
+            end = True
+            break
+        models.append(Model(result['name'], result['uid']))
+    next_url = response.get('next')
+    return models, next_url, end or not next_url
+
+
+def read_seen_mids(fileout):
+    if not os.path.isfile(fileout):
+        return set()
+    return set(mid for (_, mid) in read_catalog(fileout))
+
+
+def collect_model_urls_api(fileout, requests_per_second=None):
+    """
+    Page through the JSON model listing, streaming name|mid rows of every
+    model with at least LIKE_LIMIT likes to fileout.
+
+    If fileout already exists, only models which are not in it yet are
+    appended. The listing is sorted by likes and models which newly reach
+    LIKE_LIMIT can show up anywhere in it, so every page down to LIKE_LIMIT
+    is still requested.
+    """
+    if requests_per_second is None:
+        requests_per_second = REQUESTS_PER_SECOND
+    seen = read_seen_mids(fileout)
+    session = fetch.make_session(1)
+    limiter = fetch.TokenBucket(requests_per_second)
+    new_file = not os.path.isfile(fileout)
+    written = 0
+    page = 1
+    with open(fileout, 'a', newline='') as f:
+        modelwriter = csv.writer(f, delimiter='|', quotechar='\\',
+                                 quoting=csv.QUOTE_MINIMAL)
+        if new_file:
+            modelwriter.writerow(['name', 'mid'])
+        url = CATALOG_API_URL
+        params = {'sort_by': '-likeCount', 'count': 24}
+        end = False
+        while not end:
+            print('Grabbing info from page {}'.format(page))
+            models, url, end = get_catalog_page(session, url, params,
+                                                limiter)
+            # The next url already has the query string
+            params = None
+            new_models = [model for model in models if model.mid not in seen]
+            for model in new_models:
+                seen.add(model.mid)
+                modelwriter.writerow(list(model))
+            written += len(new_models)
+            f.flush()
+            page += 1
+    print('Wrote {} new models, {} total'.format(written, len(seen)))
+
+
+def get_model_likes(mid, User, count=24, session=None, limiter=None):
     """
     Query Sketchfab API to grab likes for each model.
 
@@ -146,12 +231,19 @@ def get_model_likes(mid, User, count=24):
     count : int, (optional)
         Number of likes requested to be returned by the API. 24 seems to be the
         max.
+    session : requests.Session, (optional)
+        Session to reuse connections from.
+    limiter : fetch.TokenBucket, (optional)
+        Rate limiter shared by all requests.
 
     Returns
     -------
     users : list
         List of User tuples containing all users that liked mid.
 
+    Transient errors are retried with backoff. If they persist, the error is
+    raised rather than returning a partial list of likes.
+
     Inspired by http://www.gregreda.com/2015/02/15/web-scraping-finding-the-api/
 
     for example: "https://sketchfab.com/i/likes?count=24&model=034a1a146e304161b7c45b9354ed2dfd&offset=48"
@@ -159,31 +251,29 @@ def get_model_likes(mid, User, count=24):
     034a1a146e304161b7c45b9354ed2dfd
     In return payload, if there's not 'next' key, then there's no more likes left.
     """
+    if session is None:
+        session = fetch.make_session(1)
 
     done = False
     params = {'model':mid, 'count':count, 'offset':0}
     users = []
     while not done:
-        try:
-            response = requests.get(BASE_LIKES_URL, params=params).json()
-            results = response['results']
-            for result in results:
-                # Grab username instead.
-                # Good to store for getting url later down the line.
-                name = result['username']
-                uid = result['uid']
-                users.append(User(name, uid))
-            if not response['next']:
-                done = True
-                if len(users) % count != len(results):
-                    print('Might be missing some likes on {}'.format(mid))
-            else:
-                # Grab the next batch of likes
-                params['offset'] = params['offset'] + count
-
-        except:
+        response = fetch.get_json(session, BASE_LIKES_URL, params=params,
+                                  limiter=limiter)
+        results = response['results']
+        for result in results:
+            # Grab username instead.
+            # Good to store for getting url later down the line.
+            name = result['username']
+            uid = result['uid']
+            users.append(User(name, uid))
+        if not response.get('next'):
             done = True
-            print('Error on mid: {}'.format(mid))
+            if len(users) % count != len(results):
+                print('Might be missing some likes on {}'.format(mid))
+        else:
+            # Grab the next batch of likes
+            params['offset'] = params['offset'] + count
     return users
 
 
@@ -199,46 +289,160 @@ def write_model_likes(filename, model_name, mid, user_set):
             print('\t' + '|'.join([x for x in line]))
 
 
-def get_model_features(url, chromedriver):
-    """For given model url, grab categories and tags for that model"""
-    try:
-        BROWSER.get(url)
-        time.sleep(5)
-        cats = BROWSER.find_elements_by_xpath("//section[@class='model-meta-row categories']//ul//a")
-        cats = [cat.text for cat in cats]
-
-        tags = BROWSER.find_elements_by_xpath("//section[@class='model-meta-row tags']//ul//a")
-        tags = [tag.text for tag in tags]
-    except:
-        print('Difficulty grabbing these features {}'.format(url))
-        print('Reload browser and try again')
-        cats, tags = None, None
+CATEGORIES_XPATH = "//section[@class='model-meta-row categories']//ul//a"
+TAGS_XPATH = "//section[@class='model-meta-row tags']//ul//a"
+# Rendered on every model page, whether or not it has categories or tags
+MODEL_META_XPATH = "//*[contains(@class, 'model-meta-row')]"
+
+
+def make_headless_browser(chromedriver):
+    """Start a new headless Chrome session"""
+    options = webdriver.ChromeOptions()
+    options.add_argument('--headless')
+    options.add_argument('--disable-gpu')
+    return webdriver.Chrome(chromedriver, chrome_options=options)
+
+
+def page_ready(browser):
+    """True once the page has loaded and its model metadata is rendered."""
+    return (browser.execute_script('return document.readyState') == 'complete'
+            and bool(browser.find_elements_by_xpath(MODEL_META_XPATH)))
+
+
+def get_model_features(url, browser, timeout=15):
+    """
+    For given model url, grab categories and tags for that model
+
+    Waits up to timeout seconds for the page to load rather than sleeping for
+    a fixed amount of time, and raises if it does not. A model without
+    categories or tags gets empty lists.
+    """
+    browser.get(url)
+    WebDriverWait(browser, timeout).until(page_ready)
+    cats = browser.find_elements_by_xpath(CATEGORIES_XPATH)
+    cats = [cat.text for cat in cats]
+
+    tags = browser.find_elements_by_xpath(TAGS_XPATH)
+    tags = [tag.text for tag in tags]
     return cats, tags
 
-def single_thumb(mid, thumbs_dir, thumbs_suffix):
-    time.sleep(.2)
+
+def features_worker(driver_factory, tasks, results, timeout):
+    """
+    Pull mids off the tasks queue until a None arrives, putting
+    (mid, cats, tags, error) on the results queue. A mid which fails gets
+    one more try in a freshly started browser.
+    """
+    browser = driver_factory()
     try:
-        response = requests.get(BASE_THUMBS_URL + mid).json()
+        while True:
+            mid = tasks.get()
+            if mid is None:
+                break
+            url = BASE_MODEL_URL + mid
+            try:
+                cats, tags = get_model_features(url, browser, timeout)
+            except Exception:
+                print('Difficulty grabbing these features {}'.format(url))
+                print('Reload browser and try again')
+                try:
+                    browser.quit()
+                except Exception:
+                    pass
+                try:
+                    browser = driver_factory()
+                    cats, tags = get_model_features(url, browser, timeout)
+                except Exception as e:
+                    results.put((mid, None, None, e))
+                    continue
+            results.put((mid, cats, tags, None))
+    finally:
+        browser.quit()
+
+
+THREAD_LOCAL = threading.local()
+
+
+def thread_session():
+    """Keep-alive session owned by the current thread."""
+    if not hasattr(THREAD_LOCAL, 'session'):
+        THREAD_LOCAL.session = fetch.make_session(1)
+    return THREAD_LOCAL.session
+
+
+def download(session, url, path, limiter=None, etag=None):
+    """
+    Stream url to path. If etag is given and the server says the file has
+    not changed, nothing is written. Returns the new ETag, if any.
+    """
+    headers = {'If-None-Match': etag} if etag else {}
+    response = fetch.get_response(session, url, limiter=limiter,
+                                  headers=headers, stream=True)
+    if response.status_code == 304:
+        return etag
+    tmp_path = path + '.part'
+    with open(tmp_path, 'wb') as fout:
+        for chunk in response.iter_content(chunk_size=64 * 1024):
+            fout.write(chunk)
+    os.replace(tmp_path, path)
+    return response.headers.get('ETag')
+
+
+def single_thumb(mid, thumbs_dir, thumbs_suffix, limiter=None,
+                 refresh=False):
+    """
+    Download the 200x200 thumbnail for mid. Existing non-empty thumbnails are
+    skipped unless refresh is set, in which case they are only downloaded
+    again if their ETag has changed.
+    """
+    path = os.path.join(thumbs_dir, '{}_{}'.format(mid, thumbs_suffix))
+    etag_path = path + '.etag'
+    exists = os.path.isfile(path) and os.path.getsize(path) > 0
+    if exists and not refresh:
+        return {'mid': mid, 'status': True}
+
+    etag = None
+    if exists and os.path.isfile(etag_path):
+        with open(etag_path, 'r') as f:
+            etag = f.read().strip() or None
+    try:
+        session = thread_session()
+        response = fetch.get_json(session, BASE_THUMBS_URL + mid,
+                                  limiter=limiter)
         thumb = [x['url'] for x in response['thumbnails']['images']
                  if x['width'] == 200 and x['height']==200]
-        path = os.path.join(thumbs_dir, '{}_{}'.format(mid, thumbs_suffix))
-        fname, _ = urllib.request.urlretrieve(thumb[0], path)
-        status= True
-    except:
+        new_etag = download(session, thumb[0], path, limiter=limiter,
+                            etag=etag)
+        if new_etag and new_etag != etag:
+            with open(etag_path, 'w') as f:
+                f.write(new_etag)
+        status = True
+    except Exception:
         status = False
     return {'mid': mid, 'status': status}
 
-def get_model_thumbs(urls, thumbs_dir, thumbs_suffix):
-    """Get 200 pixel thumbnails for a list of mids"""
+
+def get_model_thumbs(urls, thumbs_dir, thumbs_suffix, refresh=False):
+    """
+    Get 200 pixel thumbnails for a list of mids
+
+    Downloads run on MAX_WORKERS threads, each with its own keep-alive
+    session, and share a single REQUESTS_PER_SECOND rate limit.
+    """
     df = pd.read_csv(urls, delimiter='|', quotechar='\\',
                      quoting=csv.QUOTE_MINIMAL)
     mids = df['mid'].unique().tolist()
     ctr = 0
     total = len(mids)
     t0 = time.time()
+    limiter = fetch.TokenBucket(REQUESTS_PER_SECOND)
+    if not os.path.isdir(thumbs_dir):
+        os.makedirs(thumbs_dir)
 
-    with ProcessPoolExecutor(max_workers=MAX_WORKERS) as executor:
-        future_results = {executor.submit(single_thumb, mid, thumbs_dir, thumbs_suffix): mid for mid in mids}
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        future_results = {executor.submit(single_thumb, mid, thumbs_dir,
+                                          thumbs_suffix, limiter, refresh): mid
+                          for mid in mids}
 
         results = []
         for future in concurrent.futures.as_completed(future_results):
@@ -258,79 +462,191 @@ def get_model_thumbs(urls, thumbs_dir, thumbs_suffix):
             print(r['mid'])
             failed.append(r['mid'])
 
-    with open('failed_mids.psv', 'w') as fout:
-        writer = csv.writer(fout)
-        writer.writerow('mid')
+    with open('failed_mids.psv', 'w', newline='') as fout:
+        writer = csv.writer(fout, delimiter='|', quotechar='\\',
+                            quoting=csv.QUOTE_MINIMAL)
+        writer.writerow(['mid'])
         for failure in failed:
-            writer.writerow(failure)
+            writer.writerow([failure])
+    return failed
+
 
+def read_catalog(catalog):
+    """List of (model_name, mid) rows from the model urls file."""
+    with open(catalog, 'r') as f:
+        reader = csv.reader(f, delimiter='|', quoting=csv.QUOTE_MINIMAL,
+                            quotechar='\\')
+        next(reader, None)
+        return [(row[0], row[1]) for row in reader]
 
-def crawl_model_likes(catalog, likes_filename):
+
+def drop_unfinished_likes(likes_filename, checkpoint):
     """
-    For each model in catalog (model urls), get every user id for every user
-    that liked that model
+    Remove the likes of models that are not in checkpoint from
+    likes_filename. These were written by a crawl which stopped before
+    checkpointing them, and are crawled again.
     """
-    f = open(catalog, 'r')
-    ctr = 0
+    if not os.path.isfile(likes_filename):
+        return 0
+    dropped = 0
+    tmp_filename = likes_filename + '.tmp'
+    with open(likes_filename, 'r', newline='') as fin, \
+            open(tmp_filename, 'w', newline='') as fout:
+        reader = csv.reader(fin, delimiter='|', quoting=csv.QUOTE_MINIMAL,
+                            quotechar='\\')
+        writer = csv.writer(fout, delimiter='|', quotechar='\\',
+                            quoting=csv.QUOTE_MINIMAL)
+        for row in reader:
+            if row[1] in checkpoint:
+                writer.writerow(row)
+            else:
+                dropped += 1
+    if dropped:
+        os.replace(tmp_filename, likes_filename)
+    else:
+        os.remove(tmp_filename)
+    return dropped
+
+
+def _crawl_likes(models, likes_filename, checkpoint, concurrency,
+                 requests_per_second):
     # I've been reading Fluent Python and was inspired to create namedtuples.
     User = namedtuple('User', ['uid', 'name'])
-    reader = csv.reader(f, delimiter='|', quoting=csv.QUOTE_MINIMAL,
-                        quotechar='\\')
-    reader.readrow();
-    for row in reader:
-        ctr += 1
-        model_name, mid = row[0], row[1]
-        print(', '.join(str(x) for x in [ctr, mid, model_name]))
-        users = get_model_likes(mid, User)
-        if users:
-            write_model_likes(likes_filename, model_name, mid, users)
-
-
-def crawl_model_features(catalog, chromedriver, features_filename, start=1):
+    session = fetch.make_session(concurrency)
+    limiter = fetch.TokenBucket(requests_per_second)
+
+    def likes_for(model_name, mid):
+        try:
+            users = get_model_likes(mid, User, 24, session, limiter)
+            return model_name, mid, users, None
+        except Exception as e:
+            return model_name, mid, None, e
+
+    ctr = 0
+    failed = 0
+    t0 = time.time()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = [executor.submit(likes_for, model_name, mid)
+                   for (model_name, mid) in models]
+        # Results are written here, one at a time, as they come in.
+        for future in concurrent.futures.as_completed(futures):
+            model_name, mid, users, error = future.result()
+            ctr += 1
+            if error is not None:
+                failed += 1
+                print('Error on mid: {} ({})'.format(mid, error))
+                continue
+            print(', '.join(str(x) for x in [ctr, mid, model_name]))
+            if users:
+                write_model_likes(likes_filename, model_name, mid, users)
+            checkpoint.add(mid)
+    print('Crawled {} models in {:.1f} seconds, {} failed'
+          .format(ctr - failed, time.time() - t0, failed))
+
+
+def crawl_model_likes(catalog, likes_filename, concurrency=None,
+                      requests_per_second=None):
+    """
+    For each model in catalog (model urls), get every user id for every user
+    that liked that model
+
+    Models are crawled by concurrency threads over a shared connection pool,
+    capped at requests_per_second. Completed mids are checkpointed to
+    likes_filename + '.done' after their likes are written, so that rerunning
+    resumes an interrupted crawl. Likes of mids which were not checkpointed
+    are dropped from likes_filename on resume and crawled again, as are
+    models which failed.
+    """
+    concurrency = concurrency or CONCURRENCY
+    if requests_per_second is None:
+        requests_per_second = REQUESTS_PER_SECOND
+    checkpoint = fetch.Checkpoint(likes_filename + '.done')
+    dropped = drop_unfinished_likes(likes_filename, checkpoint)
+    if dropped:
+        print('Dropped {} likes of unfinished models'.format(dropped))
+    models = [(model_name, mid) for (model_name, mid) in read_catalog(catalog)
+              if mid not in checkpoint]
+    print('{} models already done, {} to go'.format(len(checkpoint),
+                                                    len(models)))
+    try:
+        _crawl_likes(models, likes_filename, checkpoint, concurrency,
+                     requests_per_second)
+    finally:
+        checkpoint.close()
+
+
+def crawl_model_features(catalog, driver_factory, features_filename,
+                         workers=None, timeout=15):
     """
     For each model in catalog (model urls), get categories and tags for that
     model
-    """
-    load_browser(chromedriver)
 
-    fin = open(catalog, 'r')
-    reader = csv.reader(fin, delimiter='|', quoting=csv.QUOTE_MINIMAL,
-                        quotechar='\\')
-    fout = open(features_filename, 'a')
+    Pages are loaded by a pool of workers, each driving its own browser from
+    driver_factory. Rows are written by this thread only. Finished mids,
+    including those without categories or tags, are checkpointed to
+    features_filename + '.done', so rerunning resumes an interrupted crawl.
+    Mids whose page does not load are retried on the next run.
+    """
+    workers = workers or MAX_WORKERS
+    checkpoint = fetch.Checkpoint(features_filename + '.done')
+    models = [(model_name, mid) for (model_name, mid) in read_catalog(catalog)
+              if mid not in checkpoint]
+    print('{} models already done, {} to go'.format(len(checkpoint),
+                                                    len(models)))
+    names = dict((mid, model_name) for (model_name, mid) in models)
+
+    tasks = queue.Queue()
+    results = queue.Queue()
+    for (_, mid) in models:
+        tasks.put(mid)
+    threads = []
+    for _ in range(workers):
+        tasks.put(None)
+        thread = threading.Thread(target=features_worker,
+                                  args=(driver_factory, tasks, results,
+                                        timeout))
+        thread.start()
+        threads.append(thread)
+
+    new_file = not os.path.isfile(features_filename)
+    fout = open(features_filename, 'a', newline='')
     writer = csv.writer(fout, delimiter='|', quotechar='\\',
                         quoting=csv.QUOTE_MINIMAL)
-    if start == 1:
+    if new_file:
         writer.writerow(['mid', 'type', 'value'])
-    ctr = 0
-    for row in reader:
-        ctr += 1
-        if ctr < start:
-            continue
-        model_name, mid = row[0], row[1]
-        url = BASE_MODEL_URL + mid
-        print(', '.join(str(x) for x in [ctr, mid, model_name]))
-
-        cats, tags = get_model_features(url, chromedriver)
-        if cats is None and tags is None:
-            load_browser(chromedriver)
-            time.sleep(5)
-            cats, tags = get_model_features(url, chromedriver)
-            if cats is None and tags is None:
-                print('Cant fix it! break')
-                break
-
-        if cats:
+    failed = 0
+    try:
+        ctr = 0
+        while ctr < len(models):
+            try:
+                mid, cats, tags, error = results.get(timeout=1)
+            except queue.Empty:
+                if not any(thread.is_alive() for thread in threads):
+                    print('All browsers died, stopping early')
+                    break
+                continue
+            ctr += 1
+            print(', '.join(str(x) for x in [ctr, mid, names[mid]]))
+            if error is not None:
+                failed += 1
+                print('Cant grab features for {} ({})'.format(mid, error))
+                continue
             for cat in cats:
                 line = [mid, 'category', cat]
                 print('\t' + '|'.join([x for x in line]))
                 writer.writerow(line)
-        if tags:
             for tag in tags:
                 line = [mid, 'tag', tag]
                 print('\t' + '|'.join([x for x in line]))
                 writer.writerow(line)
-    fin.close()
-    fout.close()
+            fout.flush()
+            checkpoint.add(mid)
+    finally:
+        for thread in threads:
+            thread.join()
+        fout.close()
+        checkpoint.close()
+    print('{} models failed'.format(failed))
 
 
 def prepend_path(path, filename):
@@ -342,8 +658,10 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Sketchfab Crawler')
     parser.add_argument('config', help='config file with DB and API params')
     parser.add_argument('--type', help='What\'re we gonna crawl tonight, Brain?')
-    parser.add_argument('--start', default=1, type=int,
-                        help='What row to start at')
+    parser.add_argument('--workers', default=None, type=int,
+                        help='Number of browsers for the features crawl')
+    parser.add_argument('--refresh', action='store_true',
+                        help='Re-download thumbnails whose ETag changed')
 
     args = parser.parse_args()
 
@@ -354,13 +672,19 @@ if __name__ == "__main__":
 
 
     if args.type == 'urls':
+        collect_model_urls_api(data_files['model_url_file'])
+    elif args.type == 'urls_browser':
         collect_model_urls(data_files['model_url_file'], config['chromedriver'])
     elif args.type == 'likes':
         crawl_model_likes(data_files['model_url_file'], data_files['likes_file'])
     elif args.type == 'features':
-        crawl_model_features(data_files['model_url_file'], config['chromedriver'],
-                         data_files['model_features_file'], start=args.start)
+        crawl_model_features(data_files['model_url_file'],
+                             partial(make_headless_browser,
+                                     config['chromedriver']),
+                             data_files['model_features_file'],
+                             workers=args.workers)
     elif args.type == 'thumbs':
         thumbs_dir = prepend_path(data_path, config['thumbs_dir'])
         failed = get_model_thumbs(data_files['model_url_file'],
-                                  thumbs_dir, config['thumbs_suffix'])
+                                  thumbs_dir, config['thumbs_suffix'],
+                                  refresh=args.refresh)
@@ -0,0 +1,267 @@
+"""
+Ranking metrics for recommenders on the output of helpers.train_test_split.
+
+Test users are scored a batch at a time with matrix products, so memory is
+bounded by batch_size x n_items. Training items are masked out in place, the
+top k are taken with argpartition and precision@k, recall@k, MAP@k, NDCG@k
+and AUC are computed for the whole batch at once. Batches are spread across
+a process pool.
+
+    python evaluate.py config.yml --scorer wrmf --k 10
+"""
+
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import os
+import time
+
+import numpy as np
+import scipy.sparse as sp
+import yaml
+
+import helpers
+
+
+METRICS = ('precision', 'recall', 'map', 'ndcg', 'auc')
+
+
+class FactorScorer(object):
+    """Scores users by the dot product of user and item factors."""
+
+    def __init__(self, user_factors, item_factors, item_bias=None):
+        self.user_factors = user_factors
+        self.item_factors = item_factors
+        self.item_bias = item_bias
+
+    def scores(self, users, train_rows):
+        scores = self.user_factors[users] @ self.item_factors.T
+        if self.item_bias is not None:
+            scores += self.item_bias
+        return scores
+
+
+class SimilarityScorer(object):
+    """Scores users by the summed item x item similarity of their likes."""
+
+    def __init__(self, similarity):
+        self.similarity = sp.csr_matrix(similarity)
+
+    def scores(self, users, train_rows):
+        return (train_rows @ self.similarity).toarray()
+
+
+def knn_similarity(interactions, neighbours):
+    """Sparse item x item cosine similarity restricted to neighbours.
+
+    Parameters
+    ----------
+    interactions : sparse csr matrix
+        User x item interactions.
+    neighbours : array of int (n_items x K)
+        e.g. from similarity.item_neighbours, padded with -1.
+    """
+    item_user = sp.csr_matrix(interactions.T, dtype=np.float64)
+    norms = np.sqrt(np.asarray(item_user.multiply(item_user).sum(axis=1))
+                    .ravel())
+    norms[norms == 0] = 1.
+    item_user = sp.diags(1. / norms) @ item_user
+    rows = np.repeat(np.arange(neighbours.shape[0]), neighbours.shape[1])
+    cols = neighbours.ravel()
+    rows, cols = rows[cols >= 0], cols[cols >= 0]
+    values = np.asarray(item_user[rows].multiply(item_user[cols]).sum(axis=1))
+    return sp.csr_matrix((values.ravel(), (rows, cols)),
+                         shape=(neighbours.shape[0], neighbours.shape[0]))
+
+
+def batch_metrics(scores, train_rows, test_rows, k):
+    """
+    Sums of the ranking metrics over a batch of users.
+
+    Parameters
+    ----------
+    scores : array (batch x n_items)
+        Modified in place: training items are set to -inf.
+    train_rows : sparse csr matrix
+        The batch's training interactions.
+    test_rows : sparse csr matrix
+        The batch's test interactions. Every row needs at least one.
+    k : int
+
+    Returns
+    -------
+    sums : dict
+        Metric name to the sum over the batch's users.
+    """
+    n_users, n_items = scores.shape
+    n_train = np.diff(train_rows.indptr)
+    seen = train_rows.tocoo()
+    scores[seen.row, seen.col] = -np.inf
+    n_test = np.diff(test_rows.indptr)
+    relevant = test_rows.toarray() > 0
+
+    top = helpers.top_k(scores, k)
+    hits = np.take_along_axis(relevant, top, axis=1)
+    cum_hits = np.cumsum(hits, axis=1)
+    positions = np.arange(1, k + 1)
+    discounts = 1. / np.log2(positions + 1)
+    ideal = np.cumsum(discounts)[np.minimum(n_test, k) - 1]
+
+    # Ascending rank of every item, ties sharing their mean rank. Training
+    # items are -inf so they come first, and summing the ranks of the test
+    # items counts, for each of them, the negatives and the other test
+    # items ranked below it.
+    order = np.argsort(scores, axis=1)
+    ordered = np.take_along_axis(scores, order, axis=1)
+    columns = np.broadcast_to(np.arange(n_items), scores.shape)
+    starts = np.ones(scores.shape, dtype=bool)
+    starts[:, 1:] = ordered[:, 1:] != ordered[:, :-1]
+    ends = np.ones(scores.shape, dtype=bool)
+    ends[:, :-1] = starts[:, 1:]
+    first = np.maximum.accumulate(np.where(starts, columns, 0), axis=1)
+    last = np.minimum.accumulate(np.where(ends, columns, n_items)[:, ::-1],
+                                 axis=1)[:, ::-1]
+    ranks = np.empty(scores.shape)
+    np.put_along_axis(ranks, order, (first + last) / 2., axis=1)
+    rank_sums = np.where(relevant, ranks, 0).sum(axis=1)
+    n_negative = n_items - n_train - n_test
+    correct = (rank_sums - n_test * n_train - n_test * (n_test - 1) / 2.)
+    auc = np.divide(correct, n_test * n_negative,
+                    out=np.ones(n_users), where=n_negative > 0)
+
+    return {
+        'precision': (cum_hits[:, -1] / float(k)).sum(),
+        'recall': (cum_hits[:, -1] / n_test).sum(),
+        'map': ((cum_hits / positions * hits).sum(axis=1)
+                / np.minimum(n_test, k)).sum(),
+        'ndcg': ((hits * discounts).sum(axis=1) / ideal).sum(),
+        'auc': auc.sum(),
+    }
+
+
+def _init_worker(scorer, train, test, k):
+    """Store the read-only inputs once per worker process."""
+    global SCORER, TRAIN, TEST, TOP_K
+    SCORER = scorer
+    TRAIN = train
+    TEST = test
+    TOP_K = k
+
+
+def _worker_batch(users):
+    train_rows = TRAIN[users]
+    scores = np.asarray(SCORER.scores(users, train_rows), dtype=np.float64)
+    return batch_metrics(scores, train_rows, TEST[users], TOP_K)
+
+
+def evaluate(scorer, train, test, user_index=None, k=10, batch_size=256,
+             workers=None):
+    """Mean ranking metrics of scorer over the test users.
+
+    Parameters
+    ----------
+    scorer : FactorScorer or SimilarityScorer
+        Anything with a scores(users, train_rows) method returning a dense
+        users x items array.
+    train : sparse csr matrix
+    test : sparse csr matrix
+    user_index : array of int, optional
+        Users to evaluate, as returned by helpers.train_test_split. Users
+        without test interactions are skipped.
+    k : int
+    batch_size : int
+        Users scored together. Each batch holds a few batch_size x n_items
+        arrays.
+    workers : int, optional
+        Number of worker processes. 0 evaluates in this process, e.g. when
+        already running inside a pool.
+
+    Returns
+    -------
+    metrics : dict
+        Metric name to its mean over users, plus 'users'.
+    """
+    train = sp.csr_matrix(train)
+    test = sp.csr_matrix(test)
+    if user_index is None:
+        user_index = np.arange(test.shape[0])
+    user_index = np.asarray(user_index)
+    user_index = user_index[np.diff(test.indptr)[user_index] > 0]
+    k = min(k, train.shape[1])
+
+    totals = dict.fromkeys(METRICS, 0.)
+    t0 = time.time()
+    batches = [user_index[start:start + batch_size]
+               for start in range(0, user_index.shape[0], batch_size)]
+    if workers == 0:
+        _init_worker(scorer, train, test, k)
+        results = [_worker_batch(batch) for batch in batches]
+    else:
+        with ProcessPoolExecutor(max_workers=workers,
+                                 initializer=_init_worker,
+                                 initargs=(scorer, train, test, k)) \
+                as executor:
+            results = list(executor.map(_worker_batch, batches))
+    for sums in results:
+        for metric in METRICS:
+            totals[metric] += sums[metric]
+    n_users = max(user_index.shape[0], 1)
+    metrics = {metric: float(totals[metric]) / n_users for metric in METRICS}
+    metrics['users'] = user_index.shape[0]
+    print('Evaluated {} users in {:.1f} seconds'
+          .format(user_index.shape[0], time.time() - t0))
+    return metrics
+
+
+def print_metrics(metrics, k):
+    for metric in METRICS:
+        name = metric if metric == 'auc' else '{}@{}'.format(metric, k)
+        print('{:>14} | {:.4f}'.format(name, metrics[metric]))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Train a recommender on a split of the likes and '
+                    'report ranking metrics on the held out likes')
+    parser.add_argument('config', help='config file with data locations')
+    parser.add_argument('--scorer', default='wrmf',
+                        choices=['wrmf', 'l2r', 'similarity'])
+    parser.add_argument('--k', default=10, type=int)
+    parser.add_argument('--split-count', default=2, type=int,
+                        help='Likes per user moved to the test set')
+    parser.add_argument('--fraction', default=None, type=float,
+                        help='Fraction of users to split')
+    parser.add_argument('--batch-size', default=256, type=int)
+    parser.add_argument('--workers', default=None, type=int)
+    parser.add_argument('--row-min', default=5, type=int,
+                        help='row_min for threshold_interactions_df')
+    parser.add_argument('--col-min', default=5, type=int,
+                        help='col_min for threshold_interactions_df')
+    parser.add_argument('--seed', default=None, type=int)
+
+    args = parser.parse_args()
+    config = yaml.safe_load(open(args.config, 'r'))
+    likes_file = os.path.join(config['data_dir'],
+                              config['data_files']['likes_file'])
+
+    interactions, uids, mids = helpers.load_interactions(
+        likes_file, args.row_min, args.col_min)
+    train, test, user_index = helpers.train_test_split(
+        interactions, args.split_count, fraction=args.fraction,
+        seed=args.seed)
+    if args.scorer == 'wrmf':
+        import wrmf
+        user_factors, item_factors = wrmf.train(train, seed=args.seed)
+        scorer = FactorScorer(user_factors, item_factors)
+    elif args.scorer == 'l2r':
+        import l2r
+        model = l2r.train(train, seed=args.seed)
+        scorer = FactorScorer(model.user_factors, model.item_embeddings(),
+                              model.item_bias)
+    else:
+        import similarity
+        neighbours = similarity.item_neighbours(train, K=100,
+                                                workers=args.workers)
+        scorer = SimilarityScorer(knn_similarity(train, neighbours))
+    metrics = evaluate(scorer, train, test, user_index, k=args.k,
+                       batch_size=args.batch_size, workers=args.workers)
+    print_metrics(metrics, args.k)
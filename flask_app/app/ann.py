@@ -0,0 +1,260 @@
+"""
+Approximate nearest neighbour index over item factors.
+
+The index is an inverted file: item vectors are clustered with spherical
+k-means and stored contiguously by cluster, so a query only scores the items
+in the n_probe clusters closest to it. Every array is saved as a .npy file
+and memory-mapped on load, so gunicorn workers share a single copy through
+the page cache. As with the recstore, each build is written to its own
+directory under index_dir and published by atomically replacing the CURRENT
+file, so files a worker has mapped are never rewritten.
+
+Build from the item factors saved by wrmf.py --model-dir:
+
+    python ann.py build model_dir index_dir
+
+and compare recall and latency against exact brute force search:
+
+    python ann.py benchmark index_dir
+"""
+
+import argparse
+import os
+import shutil
+import time
+
+import numpy as np
+
+
+ARRAYS = ('centroids', 'offsets', 'vectors', 'ids', 'id_order')
+
+
+def _normalize(vectors):
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.
+    return (vectors / norms).astype(np.float32)
+
+
+def _top(scores, N):
+    """Indices of the N largest scores, best first."""
+    N = min(N, scores.shape[0])
+    if N == 0:
+        return np.empty(0, dtype=np.int64)
+    top = np.argpartition(-scores, N - 1)[:N]
+    return top[np.argsort(-scores[top], kind='stable')]
+
+
+def _assign(vectors, centroids, block_size=8192):
+    assign = np.empty(vectors.shape[0], dtype=np.int64)
+    for start in range(0, vectors.shape[0], block_size):
+        scores = vectors[start:start + block_size] @ centroids.T
+        assign[start:start + block_size] = scores.argmax(axis=1)
+    return assign
+
+
+def spherical_kmeans(vectors, n_lists, iterations=10, seed=None):
+    """Cluster unit vectors by cosine similarity.
+
+    Returns
+    -------
+    centroids : array (n_lists x factors)
+    assign : array of int
+        Cluster of each vector.
+    """
+    rng = np.random.default_rng(seed)
+    centroids = vectors[rng.choice(vectors.shape[0], n_lists, replace=False)]
+    for _ in range(iterations):
+        assign = _assign(vectors, centroids)
+        sums = np.zeros_like(centroids)
+        for dim in range(vectors.shape[1]):
+            sums[:, dim] = np.bincount(assign, weights=vectors[:, dim],
+                                       minlength=n_lists)
+        empty = np.flatnonzero(~sums.any(axis=1))
+        sums[empty] = vectors[rng.choice(vectors.shape[0], empty.shape[0],
+                                         replace=False)]
+        centroids = _normalize(sums)
+    return centroids, _assign(vectors, centroids)
+
+
+def build_index(factors, ids, n_lists=None, iterations=10, seed=None):
+    """Build the inverted file arrays for a set of item factors.
+
+    Parameters
+    ----------
+    factors : array (n_items x factors)
+    ids : array
+        Maps item index to mid.
+    n_lists : int, optional
+        Number of clusters. Defaults to sqrt(n_items).
+    iterations : int
+        Number of k-means iterations.
+    seed : int, optional
+
+    Returns
+    -------
+    arrays : dict
+        Every array in ARRAYS, ready for save_index.
+    """
+    vectors = _normalize(np.asarray(factors))
+    if n_lists is None:
+        n_lists = max(1, int(np.sqrt(vectors.shape[0])))
+    centroids, assign = spherical_kmeans(vectors, n_lists, iterations, seed)
+    order = np.argsort(assign, kind='stable')
+    offsets = np.zeros(n_lists + 1, dtype=np.int64)
+    np.cumsum(np.bincount(assign, minlength=n_lists), out=offsets[1:])
+    ids = np.asarray(ids).astype(str)[order]
+    return {'centroids': centroids,
+            'offsets': offsets,
+            'vectors': vectors[order],
+            'ids': ids,
+            'id_order': np.argsort(ids, kind='stable')}
+
+
+def index_version(dirname):
+    """Identity of the CURRENT file, which changes on every published build."""
+    st = os.stat(os.path.join(dirname, 'CURRENT'))
+    return (st.st_ino, st.st_mtime_ns)
+
+
+def save_index(dirname, arrays, keep=2):
+    """
+    Write arrays to a new build directory under dirname and publish it.
+    Only the newest keep builds are kept.
+
+    Returns
+    -------
+    build_id : str
+    """
+    build_id = '{:d}'.format(int(time.time() * 1e6))
+    build_dir = os.path.join(dirname, build_id)
+    os.makedirs(build_dir)
+    for name in ARRAYS:
+        np.save(os.path.join(build_dir, name + '.npy'), arrays[name])
+
+    current = os.path.join(dirname, 'CURRENT')
+    with open(current + '.tmp', 'w') as f:
+        f.write(build_id)
+    os.replace(current + '.tmp', current)
+
+    builds = sorted(d for d in os.listdir(dirname)
+                    if os.path.isdir(os.path.join(dirname, d)))
+    for old in builds[:-keep]:
+        shutil.rmtree(os.path.join(dirname, old))
+    return build_id
+
+
+class ANNIndex(object):
+    """Memory-mapped inverted file index over item vectors."""
+
+    def __init__(self, dirname, n_probe=8):
+        """Memory-map the build of index dirname that CURRENT points to."""
+        self.version = index_version(dirname)
+        with open(os.path.join(dirname, 'CURRENT')) as f:
+            self.build_id = f.read().strip()
+        build_dir = os.path.join(dirname, self.build_id)
+        for name in ARRAYS:
+            setattr(self, name, np.load(os.path.join(build_dir,
+                                                     name + '.npy'),
+                                        mmap_mode='r'))
+        self.n_probe = n_probe
+
+    def position(self, mid):
+        """Row of mid in vectors, or None if it is not indexed."""
+        i = np.searchsorted(self.ids, mid, sorter=self.id_order)
+        if i == self.ids.shape[0]:
+            return None
+        pos = self.id_order[i]
+        if self.ids[pos] != mid:
+            return None
+        return pos
+
+    def search(self, query, N, n_probe=None, exclude=None):
+        """Positions of the approximate top N vectors for query."""
+        n_probe = n_probe or self.n_probe
+        lists = _top(self.centroids @ query, n_probe)
+        starts = self.offsets[lists]
+        lengths = self.offsets[lists + 1] - starts
+        shift = np.repeat(starts - (np.cumsum(lengths) - lengths), lengths)
+        candidates = shift + np.arange(lengths.sum())
+        scores = self.vectors[candidates] @ query
+        if exclude is not None:
+            scores[candidates == exclude] = -np.inf
+        return candidates[_top(scores, N)]
+
+    def exact_search(self, query, N, exclude=None):
+        """Positions of the exact top N vectors for query."""
+        scores = self.vectors @ query
+        if exclude is not None:
+            scores[exclude] = -np.inf
+        return _top(scores, N)
+
+    def recommend(self, mid, N, n_probe=None):
+        """Top N most similar mids to mid, or None if mid is not indexed."""
+        pos = self.position(mid)
+        if pos is None:
+            return None
+        top = self.search(self.vectors[pos], N, n_probe, exclude=pos)
+        return self.ids[top].tolist()
+
+
+def benchmark(index, n_queries=1000, N=12, probes=(1, 2, 4, 8, 16, 32),
+              seed=None):
+    """Print recall@N and mean latency per query against brute force."""
+    rng = np.random.default_rng(seed)
+    n_items = index.vectors.shape[0]
+    queries = rng.choice(n_items, min(n_queries, n_items), replace=False)
+
+    t0 = time.time()
+    exact = [index.exact_search(index.vectors[q], N, exclude=q)
+             for q in queries]
+    exact_ms = (time.time() - t0) / len(queries) * 1000
+    print('{:>8} | {:>8} | {:>10}'.format('n_probe', 'recall', 'ms/query'))
+    print('{:>8} | {:>8.4f} | {:>10.4f}'.format('exact', 1., exact_ms))
+    for n_probe in probes:
+        t0 = time.time()
+        approx = [index.search(index.vectors[q], N, n_probe, exclude=q)
+                  for q in queries]
+        ms = (time.time() - t0) / len(queries) * 1000
+        hits = sum(np.intersect1d(a, e).shape[0]
+                   for (a, e) in zip(approx, exact))
+        recall = hits / float(sum(e.shape[0] for e in exact))
+        print('{:>8} | {:>8.4f} | {:>10.4f}'.format(n_probe, recall, ms))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Item factor ANN index')
+    subparsers = parser.add_subparsers(dest='command')
+
+    build_parser = subparsers.add_parser('build', help='Build an index')
+    build_parser.add_argument('model_dir',
+                              help='Output of wrmf.py --model-dir')
+    build_parser.add_argument('index_dir')
+    build_parser.add_argument('--lists', default=None, type=int,
+                              help='Number of inverted lists')
+    build_parser.add_argument('--iterations', default=10, type=int)
+    build_parser.add_argument('--seed', default=None, type=int)
+
+    bench_parser = subparsers.add_parser('benchmark',
+                                         help='Recall vs latency benchmark')
+    bench_parser.add_argument('index_dir')
+    bench_parser.add_argument('--queries', default=1000, type=int)
+    bench_parser.add_argument('--N', default=12, type=int)
+    bench_parser.add_argument('--probes', default=[1, 2, 4, 8, 16, 32],
+                              type=int, nargs='+')
+    bench_parser.add_argument('--seed', default=None, type=int)
+
+    args = parser.parse_args()
+    if args.command == 'build':
+        factors = np.load(os.path.join(args.model_dir, 'item_factors.npy'))
+        mids = np.load(os.path.join(args.model_dir, 'mids.npy'))
+        arrays = build_index(factors, mids, n_lists=args.lists,
+                             iterations=args.iterations, seed=args.seed)
+        build_id = save_index(args.index_dir, arrays)
+        print('Wrote index of {} items in {} lists to {}'
+              .format(factors.shape[0], arrays['centroids'].shape[0],
+                      os.path.join(args.index_dir, build_id)))
+    elif args.command == 'benchmark':
+        benchmark(ANNIndex(args.index_dir), n_queries=args.queries, N=args.N,
+                  probes=args.probes, seed=args.seed)
+    else:
+        parser.print_help()
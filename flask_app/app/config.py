@@ -9,6 +9,22 @@ class BaseConfig(object):
     LOGGING_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
     LOGGING_LOCATION = 'rec.log'
     LOGGING_LEVEL = logging.INFO
+    # Read-only sqlite tuning, see database.py
+    SQLITE_MMAP_SIZE = 256 * 1024 * 1024
+    SQLITE_CACHE_SIZE = -65536
+    # Where index pages get their data from: 'sqlite', or 'mmap' for the
+    # compiled recstore.py build in RECSTORE_DIR.
+    RECS_BACKEND = 'sqlite'
+    RECSTORE_DIR = None
+    # Directory of an ann.py index. When set, wrmf recommendations are
+    # computed on demand instead of read from the recommendations table.
+    ANN_INDEX = None
+    ANN_N = 12
+    ANN_PROBES = 8
+    # Rendered index pages kept per worker, and how long browsers and nginx
+    # may reuse a page before revalidating its ETag.
+    RENDER_CACHE_SIZE = 4096
+    RENDER_CACHE_MAX_AGE = 600
 
 
 class DevelopmentConfig(BaseConfig):
@@ -0,0 +1,84 @@
+"""
+Read-only sqlite connection shared by every request of a worker.
+
+The database is opened with mode=ro&immutable=1, so sqlite skips locking and
+change detection entirely. That is only safe because the database file is
+never modified in place: helpers.py builds a new copy and os.replace()s it
+over the old one (see helpers.publish_db). Each request checks the file's
+identity with a stat() and reopens the connection when a new build shows up.
+Requests still running on the old connection keep reading the old file, and
+the old connection is closed when the last of them releases it.
+"""
+
+import os
+import sqlite3
+import threading
+from urllib.request import pathname2url
+
+
+class ReadOnlyDatabase(object):
+
+    def __init__(self, path, mmap_size=256 * 1024 * 1024, cache_size=-65536):
+        """
+        Parameters
+        ----------
+        path : str
+            sqlite database file.
+        mmap_size : int
+            Bytes of the file sqlite may memory-map.
+        cache_size : int
+            sqlite page cache size. Negative values are in KiB.
+        """
+        self.path = os.path.abspath(path)
+        self.mmap_size = mmap_size
+        self.cache_size = cache_size
+        self.lock = threading.Lock()
+        self.conn = None
+        self.conn_version = None
+        # Requests holding each open connection
+        self.holders = {}
+
+    def version(self):
+        """Identity of the database file currently at path."""
+        st = os.stat(self.path)
+        return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+    def _open(self):
+        uri = 'file:{}?mode=ro&immutable=1'.format(pathname2url(self.path))
+        conn = sqlite3.connect(uri, uri=True, check_same_thread=False)
+        conn.execute('PRAGMA mmap_size = {:d}'.format(self.mmap_size))
+        conn.execute('PRAGMA cache_size = {:d}'.format(self.cache_size))
+        return conn
+
+    def acquire(self):
+        """
+        Connection to the latest published build of the database, for one
+        request. Hand it back with release() when the request is done.
+        """
+        version = self.version()
+        with self.lock:
+            if self.conn is None or version != self.conn_version:
+                if self.conn is not None and self.conn not in self.holders:
+                    self.conn.close()
+                self.conn = self._open()
+                self.conn_version = version
+            self.holders[self.conn] = self.holders.get(self.conn, 0) + 1
+            return self.conn
+
+    def release(self, conn):
+        """Close conn if a newer build is open and nothing else holds it."""
+        with self.lock:
+            self.holders[conn] -= 1
+            if not self.holders[conn]:
+                del self.holders[conn]
+                if conn is not self.conn:
+                    conn.close()
+
+    def close(self):
+        with self.lock:
+            for conn in set(self.holders) | set([self.conn]):
+                if conn is not None:
+                    conn.close()
+            self.holders = {}
+            self.conn = None
+            self.conn_version = None
@@ -1,15 +1,29 @@
 import argparse
+import bisect
 import collections
+import contextlib
+import functools
+from concurrent.futures import ThreadPoolExecutor
 import csv
+import fcntl
 import json
 import os
+import random
 import requests
+import shutil
+import threading
 import time
 
 import pandas as pd
 import sqlite3
 import yaml
 
+try:
+    from . import retry
+except ImportError:
+    # Run as a script rather than imported from the app package
+    import retry
+
 
 def get_app_base_path():
     return os.path.dirname(os.path.realpath(__file__))
@@ -19,10 +33,24 @@ def get_instance_folder_path():
     return os.path.join(get_app_base_path(), 'instance')
 
 
+def placeholders(n):
+    """
+    Comma-separated '?' placeholders for an IN clause of n values, padded to
+    the next power of two. Padding keeps the number of distinct statements
+    small so sqlite's statement cache can reuse the prepared queries.
+    """
+    size = 1
+    while size < n:
+        size *= 2
+    return ','.join('?' * size), size
+
+
 def get_mid_data_from_db(mids, conn):
-    """Get info on a list of mids"""
-    c = conn.cursor()
-    midlist = ','.join("'{}'".format(x) for x in mids)
+    """Get info on a list of mids, in the order of mids."""
+    mids = list(mids)
+    if not mids:
+        return []
+    marks, size = placeholders(len(mids))
     sql = """
         SELECT
           mid,
@@ -33,26 +61,22 @@ def get_mid_data_from_db(mids, conn):
         WHERE
           mid IN ({})
           AND thumbnail IS NOT NULL
-    """.format(midlist)
-    c.execute(sql)
-    conn.commit()
-    results = c.fetchall()
-    c.close()
-    if results:
-        ordering = {mid: i for (i, mid) in enumerate(mids)}
-        columns = ['mid', 'name', 'thumbnail', 'url']
-        mid_data = [{c: v for c, v in zip(columns, r)} for r in results]
-        mid_data = sorted(mid_data, key=lambda x: ordering.get(x['mid'], 1000))
-    else:
-        mid_data = []
-    return mid_data
+    """.format(marks)
+    # Padding with NULL never matches anything.
+    results = conn.execute(sql, mids + [None] * (size - len(mids))).fetchall()
+    columns = ['mid', 'name', 'thumbnail', 'url']
+    found = {r[0]: {c: v for c, v in zip(columns, r)} for r in results}
+    return [found[mid] for mid in mids if mid in found]
 
 
-def get_recommendations(mid, conn):
+def get_recommendations(mid, conn, ann_index=None, N=12):
     """
     Grab recommendations for a single mid.
     Returns multiple recommendation types as a dictionary.
 
+    If ann_index is given, the top N wrmf recommendations are computed on
+    demand from the item factors instead of read from the database.
+
     Example Return
     --------------
     {
@@ -61,29 +85,72 @@ def get_recommendations(mid, conn):
     }
 
     """
-    c = conn.cursor()
     sql = """
         SELECT
           type,
-          recommended
+          recommended_mid
         FROM recommendations
         WHERE
-          mid = '{}'
-    """.format(mid)
-    c.execute(sql)
-    results = c.fetchall()
-    if results:
-        out = []
-        for r in results:
-            out.append((r[0], [str(x) for x in r[1].split(',')]))
-        out = dict(out)
-    else:
-        out = None
-    return out
+          mid = ?
+        ORDER BY type, rank
+    """
+    out = collections.OrderedDict()
+    for (rec_type, rec_mid) in conn.execute(sql, (mid,)):
+        out.setdefault(rec_type, []).append(rec_mid)
+    if ann_index is not None:
+        recs = ann_index.recommend(mid, N)
+        if recs:
+            out['wrmf'] = recs
+    return dict(out) or None
+
+
+def get_page_data(mid, conn, ann_index=None, N=12):
+    """
+    Everything the index page needs for mid in two queries: one for the data
+    on mid and one joining its recommendations, in rank order, to the data
+    on every recommended mid.
+
+    Returns
+    -------
+    mid_data : dict or None
+        None if mid is unknown, has no thumbnail, or has no recommendations.
+    rec_data : dict
+        Maps recommendation type to a list of mid data dicts, in rank order.
+    """
+    found = get_mid_data_from_db([mid], conn)
+    if not found:
+        return None, None
+    sql = """
+        SELECT
+          r.type,
+          d.mid,
+          d.name,
+          d.thumbnail,
+          d.url
+        FROM recommendations r
+        JOIN mid_data d ON d.mid = r.recommended_mid
+        WHERE
+          r.mid = ?
+          AND d.thumbnail IS NOT NULL
+        ORDER BY r.type, r.rank
+    """
+    columns = ['mid', 'name', 'thumbnail', 'url']
+    rec_data = {}
+    for r in conn.execute(sql, (mid,)):
+        rec_data.setdefault(r[0], []).append(
+            {c: v for c, v in zip(columns, r[1:])})
+    if ann_index is not None:
+        recs = ann_index.recommend(mid, N)
+        if recs:
+            rec_data['wrmf'] = get_mid_data_from_db(recs, conn)
+    rec_data = {k: v for (k, v) in rec_data.items() if v}
+    if not rec_data:
+        return None, None
+    return found[0], rec_data
 
 
 def get_mid_names(conn):
-    """Get small list of mids and names to seed dropdown menu."""
+    """Get list of mids and names to seed the model search."""
     c = conn.cursor()
     sql = 'SELECT mid, model_name from mid_names'
     c.execute(sql)
@@ -96,6 +163,58 @@ def get_mid_names(conn):
             for r in sorted(results, key=lambda x: x[1])]
 
 
+class ModelNameIndex(object):
+    """Model names sorted once for case-insensitive prefix search."""
+
+    def __init__(self, mid_names):
+        self.models = sorted(mid_names,
+                             key=lambda x: str(x['model_name']).lower())
+        self.keys = [str(m['model_name']).lower() for m in self.models]
+
+    def search(self, prefix, limit=10):
+        """Up to limit models whose name starts with prefix."""
+        prefix = prefix.lower()
+        start = bisect.bisect_left(self.keys, prefix)
+        stop = start
+        while (stop < len(self.keys) and stop - start < limit
+               and self.keys[stop].startswith(prefix)):
+            stop += 1
+        return self.models[start:stop]
+
+
+class RenderCache(object):
+    """
+    LRU cache of rendered pages shared by the threads of a worker. Unlike
+    functools.lru_cache, the caller decides what is stored, e.g. only pages
+    of mids which exist.
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.pages = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """Cached page for key, or None."""
+        with self.lock:
+            page = self.pages.get(key)
+            if page is None:
+                self.misses += 1
+            else:
+                self.pages.move_to_end(key)
+                self.hits += 1
+            return page
+
+    def put(self, key, page):
+        with self.lock:
+            self.pages[key] = page
+            self.pages.move_to_end(key)
+            while len(self.pages) > self.maxsize:
+                self.pages.popitem(last=False)
+
+
 def parse_mid(request):
     """
     Go through funky series of scenarios parsing out the mid
@@ -142,106 +261,307 @@ def load_mid_data(filename):
     return json.load(open(filename), 'r')
 
 
-def get_mid_data(mid):
-    response = requests.get('https://sketchfab.com/i/models/{}'.format(mid))
-    status = response.status_code
+THREAD_LOCAL = threading.local()
+
+
+def thread_session():
+    """Keep-alive session owned by the current thread."""
+    if not hasattr(THREAD_LOCAL, 'session'):
+        THREAD_LOCAL.session = requests.Session()
+    return THREAD_LOCAL.session
+
+
+def get_mid_data(mid, session=None, limiter=None):
+    """
+    Name, thumbnail and url of mid. Transient failures (connection errors,
+    429 and 5xx) are retried with backoff by retry.get_response and raise
+    once retries run out. Only a 404, i.e. a model which is gone, gives an
+    empty row.
+    """
+    session = session or requests.Session()
+    try:
+        response = retry.get_response(
+            session, 'https://sketchfab.com/i/models/{}'.format(mid),
+            limiter=limiter)
+    except requests.HTTPError as e:
+        if e.response is None or e.response.status_code != 404:
+            raise
+        return {'mid': mid, 'thumbnail': None, 'name': 'NA', 'url': 'NA',
+                'fetched_at': time.time()}
     response = response.json()
-    if status != 200:
-        thumb = None
-        name = 'NA'
-        url = 'NA'
+    thumb = [x['url'] for x in response['thumbnails']['images']
+             if x['width'] == 200 and x['height'] == 200]
+    if thumb:
+        thumb = thumb[0]
     else:
-        thumb = [x['url'] for x in response['thumbnails']['images']
-                 if x['width'] == 200 and x['height'] == 200]
-        name = response['name']
-        url = response['viewerUrl']
-        if thumb:
-            thumb = thumb[0]
-        else:
-            thumb = None
-    return {'thumbnail': thumb, 'name': name, 'url': url}
-
-
-def compile_all_mid_data(mid_list):
+        thumb = None
+    return {'mid': mid, 'thumbnail': thumb, 'name': response['name'],
+            'url': response['viewerUrl'], 'fetched_at': time.time()}
+
+
+def _fetch_mid_data(mid, limiter=None):
+    try:
+        return get_mid_data(mid, session=thread_session(), limiter=limiter)
+    except Exception as e:
+        print('Error on mid: {} ({})'.format(mid, e))
+        return None
+
+
+def compile_all_mid_data(mid_list, executor, limiter=None):
+    """
+    Fetch data for every mid on the executor's threads, sharing limiter.
+    Mids which fail are left out of the returned list, so their existing
+    rows and fetched_at stay untouched and they are retried next time.
+    """
     all_mid_data = []
     t0 = time.time()
-    for i, mid in enumerate(mid_list):
-        if i % 50 == 0:
+    fetch_mid_data = functools.partial(_fetch_mid_data, limiter=limiter)
+    for i, mid_data in enumerate(executor.map(fetch_mid_data, mid_list)):
+        if i % 50 == 0 and i > 0:
             t1 = time.time()
             print('mid count {}, {} seconds/mid'.format(i, (t1 - t0) / 50))
             t0 = time.time()
-        all_mid_data.append(get_mid_data(mid))
+        if mid_data is not None:
+            all_mid_data.append(mid_data)
     return all_mid_data
 
 
-def get_and_update_mid_data_table(sqlite_file, mid_data_filename, mid_list):
-    all_mid_data = compile_all_mid_data(mid_list)
-    df = pd.DataFrame.from_records(all_mid_data)
-    df['mid'] = mid_list
-    df = df[['mid', 'name', 'thumbnail', 'url']]
-    df.to_csv(mid_data_filename, index=False, sep='|', quotechar='\\',
-              quoting=csv.QUOTE_MINIMAL)
-    create_mid_data_table(sqlite_file, mid_data_filename)
+MID_DATA_COLUMNS = ['mid', 'name', 'thumbnail', 'url', 'fetched_at']
 
 
-def create_mid_data_table(sqlite_file, mid_data_filename):
-    conn = sqlite3.connect(sqlite_file)
-    c = conn.cursor()
-    c.execute('DROP TABLE IF EXISTS mid_data')
-    conn.commit()
+def ensure_mid_data_table(conn):
+    """Create mid_data, or add fetched_at to a table which predates it."""
     sql = """
           CREATE TABLE IF NOT EXISTS mid_data (
             mid TEXT PRIMARY KEY,
             name TEXT,
             thumbnail TEXT,
-            url TEXT
+            url TEXT,
+            fetched_at REAL
           )
           """
-    c.execute(sql)
+    conn.execute(sql)
+    columns = [r[1] for r in conn.execute('PRAGMA table_info(mid_data)')]
+    if 'fetched_at' not in columns:
+        conn.execute('ALTER TABLE mid_data ADD COLUMN fetched_at REAL')
     conn.commit()
 
+
+def get_stale_mids(conn, mid_list, max_age):
+    """Mids which are missing from mid_data or older than max_age seconds."""
+    cutoff = time.time() - max_age
+    fresh = set(r[0] for r in conn.execute(
+        'SELECT mid FROM mid_data WHERE fetched_at >= ?', (cutoff,)))
+    return [mid for mid in mid_list if mid not in fresh]
+
+
+def upsert_mid_data(conn, rows, batch_size=500):
+    """Insert or replace rows of mid_data, one transaction per batch."""
+    sql = """
+        INSERT OR REPLACE INTO mid_data (mid, name, thumbnail, url, fetched_at)
+        VALUES (?, ?, ?, ?, ?)
+    """
+    for start in range(0, len(rows), batch_size):
+        batch = rows[start:start + batch_size]
+        with conn:
+            conn.executemany(sql, [tuple(r[c] for c in MID_DATA_COLUMNS)
+                                   for r in batch])
+
+
+def get_and_update_mid_data_table(sqlite_file, mid_data_filename, mid_list,
+                                  max_age_days=7, max_workers=16,
+                                  batch_size=500, requests_per_second=10):
+    """
+    Refresh mid_data for mids which are new or were last fetched more than
+    max_age_days ago. Requests from all threads share one rate limit. Rows
+    are upserted batch by batch, so the table is never empty while the
+    refresh runs. The whole table is then dumped to mid_data_filename.
+    """
+    limiter = retry.TokenBucket(requests_per_second)
+    conn = sqlite3.connect(sqlite_file)
+    ensure_mid_data_table(conn)
+    stale = get_stale_mids(conn, mid_list, max_age_days * 24 * 60 * 60)
+    print('Refreshing {} of {} mids'.format(len(stale), len(mid_list)))
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for start in range(0, len(stale), batch_size):
+            batch = stale[start:start + batch_size]
+            upsert_mid_data(conn,
+                            compile_all_mid_data(batch, executor, limiter),
+                            batch_size=batch_size)
+
+    df = pd.read_sql('SELECT {} FROM mid_data'.format(
+        ', '.join(MID_DATA_COLUMNS)), conn)
+    df.to_csv(mid_data_filename, index=False, sep='|', quotechar='\\',
+              quoting=csv.QUOTE_MINIMAL)
+    conn.close()
+
+
+def create_mid_data_table(sqlite_file, mid_data_filename):
+    """Upsert every row of a mid_data csv dump into the mid_data table."""
+    conn = sqlite3.connect(sqlite_file)
+    ensure_mid_data_table(conn)
     df = pd.read_csv(mid_data_filename,
                      sep='|', quotechar='\\',
                      quoting=csv.QUOTE_MINIMAL)
-    df.to_sql('mid_data', con=conn, index=False, if_exists='append')
+    if 'fetched_at' not in df:
+        df['fetched_at'] = None
+    df = df[MID_DATA_COLUMNS].astype(object).where(df.notnull(), None)
+    upsert_mid_data(conn, df.to_dict('records'))
     conn.close()
 
 
 def filter_recs(recs, mid_data_filename, N=6):
-    mid_data = pd.read_csv(mid_data_filename)
-    filtered = collections.defaultdict(list)
-    for mid, others in recs.iteritems():
-        ctr = 0
-        idx = 0
-        if others:
-            while ctr < N:
-                other = others[idx]
-                if mid_data[mid_data.mid == other].thumbnail is not None:
-                    filtered[mid].append(other)
-                    ctr += 1
-                idx += 1
-        else:
+    """
+    Keep the first N recommendations of each mid that have a thumbnail in
+    mid_data_filename. The training scripts already do this on export, see
+    helpers.export_recs in the repository root.
+    """
+    mid_data = pd.read_csv(mid_data_filename, sep='|', quotechar='\\',
+                           usecols=['mid', 'thumbnail'])
+    with_thumbnail = set(mid_data.loc[mid_data['thumbnail'].notnull(), 'mid'])
+    filtered = {}
+    for mid, others in recs.items():
+        if not others:
             print('No recs for mid = {}'.format(mid))
+            continue
+        filtered[mid] = [o for o in others if o in with_thumbnail][:N]
     return filtered
 
 
 def write_recs(recs, filename):
+    """Write recs in the mid|rec1|rec2|... format read by load_recs."""
     with open(filename, 'w') as f:
         for k, v in recs.items():
-            line = '{},{}\n'.format(k, ','.join(x for x in v))
-            f.write(line)
+            f.write('|'.join([k] + list(v)) + '\n')
+
+
+@contextlib.contextmanager
+def publish_db(sqlite_file):
+    """
+    Yield the path of a working copy of sqlite_file. If the block finishes,
+    the copy atomically replaces sqlite_file; otherwise it is thrown away.
+    The served database file is therefore never modified in place, which
+    the app's immutable read-only connections rely on.
+
+    Writers take an exclusive lock on sqlite_file + '.lock' for the whole
+    copy, edit and replace, so a concurrent task waits for this one and
+    then starts from its result instead of overwriting it.
+    """
+    with open(sqlite_file + '.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        tmp_file = sqlite_file + '.building'
+        if os.path.isfile(sqlite_file):
+            shutil.copyfile(sqlite_file, tmp_file)
+        try:
+            yield tmp_file
+        except BaseException:
+            if os.path.isfile(tmp_file):
+                os.remove(tmp_file)
+            raise
+        os.replace(tmp_file, sqlite_file)
+
+
+CREATE_RECOMMENDATIONS = """
+    CREATE TABLE {} (
+      mid TEXT NOT NULL,
+      type TEXT NOT NULL,
+      rank INTEGER NOT NULL,
+      recommended_mid TEXT NOT NULL,
+      PRIMARY KEY (mid, type, rank)
+    ) WITHOUT ROWID
+"""
+INSERT_RECOMMENDATIONS = """
+    INSERT INTO {} (mid, type, rank, recommended_mid) VALUES (?, ?, ?, ?)
+"""
+
+
+def recommendation_rows(rec_type, recs):
+    """(mid, type, rank, recommended_mid) rows for a dict of rec lists."""
+    for (mid, rec_mids) in recs.items():
+        for (rank, rec_mid) in enumerate(rec_mids):
+            if rec_mid:
+                yield (mid, rec_type, rank, rec_mid)
+
+
+def _swap_recommendations(conn, rows):
+    """Replace the recommendations table with rows in one transaction."""
+    conn.isolation_level = None
+    conn.execute('BEGIN')
+    try:
+        conn.execute('DROP TABLE IF EXISTS recommendations_new')
+        conn.execute(CREATE_RECOMMENDATIONS.format('recommendations_new'))
+        conn.executemany(INSERT_RECOMMENDATIONS.format('recommendations_new'),
+                         rows)
+        conn.execute('DROP TABLE IF EXISTS recommendations')
+        conn.execute('ALTER TABLE recommendations_new '
+                     'RENAME TO recommendations')
+        conn.execute('COMMIT')
+    except BaseException:
+        conn.execute('ROLLBACK')
+        raise
+
+
+def ensure_recommendations_table(conn):
+    """
+    Create the recommendations table, converting the older layout of one
+    comma-joined string per (mid, type) if that is what is there.
+    """
+    columns = [r[1] for r in
+               conn.execute('PRAGMA table_info(recommendations)')]
+    if not columns:
+        conn.execute(CREATE_RECOMMENDATIONS.format('recommendations'))
+        conn.commit()
+    elif 'recommended' in columns:
+        old = conn.execute(
+            'SELECT mid, type, recommended FROM recommendations').fetchall()
+        rows = [row for (mid, rec_type, recommended) in old
+                for row in recommendation_rows(
+                    rec_type, {mid: recommended.split(',')})]
+        _swap_recommendations(conn, rows)
 
 
 def insert_recs(rec_type, filename, sqlite_file):
-    """Write recommendations to database as string'd list."""
+    """Replace all recommendations of rec_type with those in filename."""
     recs = load_recs(filename)
-    for (k, v) in recs.items():
-        recs[k] = ','.join(str(x) for x in v)
-    recs = pd.DataFrame(pd.Series(recs), columns=['recommended'])
-    recs['type'] = rec_type
-    recs.index.name = 'mid'
     conn = sqlite3.connect(sqlite_file)
-    recs.to_sql('recommendations', con=conn, if_exists='append')
+    ensure_recommendations_table(conn)
+    with conn:
+        conn.execute('DELETE FROM recommendations WHERE type = ?',
+                     (rec_type,))
+        conn.executemany(INSERT_RECOMMENDATIONS.format('recommendations'),
+                         recommendation_rows(rec_type, recs))
+    conn.close()
+
+
+def upsert_recs(rec_type, recs, sqlite_file):
+    """Replace the recommendations of rec_type for just the mids in recs."""
+    conn = sqlite3.connect(sqlite_file)
+    ensure_recommendations_table(conn)
+    with conn:
+        conn.executemany('DELETE FROM recommendations '
+                         'WHERE mid = ? AND type = ?',
+                         ((mid, rec_type) for mid in recs))
+        conn.executemany(INSERT_RECOMMENDATIONS.format('recommendations'),
+                         recommendation_rows(rec_type, recs))
+    conn.close()
+
+
+def insert_all_recs(rec_files, sqlite_file):
+    """
+    Rebuild the recommendations table from a dict of rec type to recs
+    file, swapping it in atomically. Missing files are skipped.
+    """
+    def rows():
+        for (rec_type, filename) in rec_files.items():
+            if not os.path.isfile(filename):
+                print('No recs file for {} at {}'.format(rec_type, filename))
+                continue
+            for row in recommendation_rows(rec_type, load_recs(filename)):
+                yield row
+    conn = sqlite3.connect(sqlite_file)
+    _swap_recommendations(conn, rows())
+    conn.close()
 
 
 def insert_modelnames(filename, sqlite_file):
@@ -249,6 +569,34 @@ def insert_modelnames(filename, sqlite_file):
                                quotechar='\\', names=['model_name', 'mid'])
     conn = sqlite3.connect(sqlite_file)
     mid_and_name.to_sql('mid_names', con=conn, index=False)
+    conn.close()
+
+
+def load_mid_data_rows(mid_data_filename):
+    """mid_data csv dump as a list of dicts, with missing values as None."""
+    df = pd.read_csv(mid_data_filename, sep='|', quotechar='\\',
+                     quoting=csv.QUOTE_MINIMAL)
+    df = df.astype(object).where(df.notnull(), None)
+    return df.to_dict('records')
+
+
+def benchmark_backends(sqlite_file, rec_store, n_queries=1000, seed=0):
+    """Time index page lookups against sqlite and the recstore."""
+    conn = sqlite3.connect(sqlite_file)
+    mids = [r[0] for r in
+            conn.execute('SELECT DISTINCT mid FROM recommendations')]
+    random.seed(seed)
+    mids = [random.choice(mids) for _ in range(n_queries)]
+    results = []
+    for (name, lookup) in [('sqlite', lambda m: get_page_data(m, conn)),
+                           ('mmap', rec_store.get_page_data)]:
+        t0 = time.time()
+        for mid in mids:
+            lookup(mid)
+        results.append((name, (time.time() - t0) / len(mids) * 1000))
+    print('{:>8} | {:>10}'.format('backend', 'ms/page'))
+    for (name, ms) in results:
+        print('{:>8} | {:>10.4f}'.format(name, ms))
 
 
 if __name__ == '__main__':
@@ -259,11 +607,16 @@ if __name__ == '__main__':
     parser.add_argument('--task',
                         help='Which helper function to call.\nAvailable '
                              'options include "update_mids", "insert_recs", '
-                             'and "insert_modelnames.')
+                             '"upsert_recs", "insert_modelnames", '
+                             '"build_recstore" and "benchmark_backends".')
+    parser.add_argument('--max-age-days', default=7, type=float,
+                        help='Refetch mid data older than this.')
+    parser.add_argument('--workers', default=16, type=int,
+                        help='Concurrent requests for update_mids.')
     args = parser.parse_args()
 
     # Parse config file
-    config = yaml.load(open(args.config, 'r'))
+    config = yaml.safe_load(open(args.config, 'r'))
 
     # All data files output from crawl.py
     data_dir = config['data_dir']
@@ -278,16 +631,53 @@ if __name__ == '__main__':
     sqlite_file = os.path.join(db_dir, db_files['sqlite_file'])
     mid_data_file = os.path.join(db_dir, db_files['mid_data_file'])
     mid_names_file = os.path.join(db_dir, db_files['mid_names_file'])
+    recstore_dir = os.path.join(db_dir, db_files.get('recstore_dir',
+                                                     'recstore'))
 
     if args.task == 'update_mids':
         model_urls = pd.read_csv(model_url_file, sep='|',
                                  quoting=csv.QUOTE_MINIMAL,
                                  quotechar='\\')
         mid_list = model_urls['mid'].unique().tolist()
-        get_and_update_mid_data_table(sqlite_file, mid_data_file, mid_list)
+        with publish_db(sqlite_file) as building_file:
+            get_and_update_mid_data_table(building_file, mid_data_file,
+                                          mid_list,
+                                          max_age_days=args.max_age_days,
+                                          max_workers=args.workers,
+                                          requests_per_second=config.get(
+                                              'REQUESTS_PER_SECOND', 10))
     elif args.task == 'insert_recs':
-        for key, filename in db_files['recs'].items():
-            filename = os.path.join(db_dir, filename)
-            insert_recs(key, filename, sqlite_file)
+        rec_files = {key: os.path.join(db_dir, filename)
+                     for (key, filename) in db_files['recs'].items()}
+        with publish_db(sqlite_file) as building_file:
+            insert_all_recs(rec_files, building_file)
+    elif args.task == 'upsert_recs':
+        # Written by incremental.py next to the full recs files
+        deltas = {key: os.path.join(db_dir, filename) + '.delta'
+                  for (key, filename) in db_files['recs'].items()}
+        deltas = {key: filename for (key, filename) in deltas.items()
+                  if os.path.isfile(filename)}
+        with publish_db(sqlite_file) as building_file:
+            for (rec_type, filename) in deltas.items():
+                recs = load_recs(filename)
+                upsert_recs(rec_type, recs, building_file)
+                print('Upserted {} recs of {} mids'
+                      .format(rec_type, len(recs)))
+        for filename in deltas.values():
+            os.remove(filename)
     elif args.task == 'insert_modelnames':
-        insert_modelnames(mid_names_file, sqlite_file)
+        with publish_db(sqlite_file) as building_file:
+            insert_modelnames(mid_names_file, building_file)
+    elif args.task == 'build_recstore':
+        from recstore import build
+        recs_by_type = {}
+        for (key, filename) in db_files['recs'].items():
+            filename = os.path.join(db_dir, filename)
+            if os.path.isfile(filename):
+                recs_by_type[key] = load_recs(filename)
+        build_id = build(recstore_dir, recs_by_type,
+                         load_mid_data_rows(mid_data_file))
+        print('Published recstore build {}'.format(build_id))
+    elif args.task == 'benchmark_backends':
+        from recstore import RecStore
+        benchmark_backends(sqlite_file, RecStore(recstore_dir))
@@ -0,0 +1,217 @@
+"""
+Compiled, memory-mapped recommendation store.
+
+An alternative to sqlite for serving: recommendations only change with the
+nightly build, so they are compiled into flat arrays and memory-mapped by
+every gunicorn worker, sharing one copy through the page cache.
+
+    hashes            uint64, sorted 64-bit hash of every mid
+    record_offsets    int64, start of each item's record in record_data
+    record_data       uint8, utf-8 mid, name, thumbnail and url of every
+                      item, joined by SEPARATOR
+    has_thumbnail     bool
+    <type>_offsets    int64, start of each item's neighbours
+    <type>_neighbours int32, item positions, best first
+
+A lookup is a binary search over hashes, one fancy index into
+has_thumbnail and record_offsets for all neighbours of a type, and one
+slice of record_data per record. Each build is written to its own directory
+and published by atomically replacing the CURRENT file, so a worker can
+switch builds between requests.
+
+Build with helpers.py --task build_recstore.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+
+import numpy as np
+
+
+FIELDS = ('mid', 'name', 'thumbnail', 'url')
+SEPARATOR = '\x1f'
+
+
+def mid_hash(mid):
+    return int.from_bytes(hashlib.blake2b(mid.encode('utf-8'),
+                                          digest_size=8).digest(), 'little')
+
+
+def _pack_strings(values):
+    """utf-8 bytes of values back to back, plus offsets."""
+    encoded = [(v or '').encode('utf-8') for v in values]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(e) for e in encoded], out=offsets[1:])
+    data = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+    return offsets, data
+
+
+def build(store_dir, recs_by_type, mid_data, keep=2):
+    """
+    Compile recommendations and mid data into a new build of the store.
+
+    Parameters
+    ----------
+    store_dir : str
+    recs_by_type : dict
+        Maps rec type to a dict of mid to a list of recommended mids, as
+        returned by helpers.load_recs.
+    mid_data : list of dict
+        Rows with mid, name, thumbnail and url.
+    keep : int
+        Number of builds to keep around, including the new one.
+
+    Returns
+    -------
+    build_id : str
+    """
+    mids = set(d['mid'] for d in mid_data)
+    for recs in recs_by_type.values():
+        mids.update(recs.keys())
+        for rec_mids in recs.values():
+            mids.update(m for m in rec_mids if m)
+    mids = sorted(mids)
+    hashes = np.array([mid_hash(m) for m in mids], dtype=np.uint64)
+    order = np.argsort(hashes, kind='stable')
+    hashes = hashes[order]
+    if np.any(hashes[1:] == hashes[:-1]):
+        raise ValueError('mid hash collision')
+    mids = [mids[i] for i in order]
+    position = {mid: i for (i, mid) in enumerate(mids)}
+
+    by_mid = {d['mid']: d for d in mid_data}
+    rows = [by_mid.get(mid, {'mid': mid}) for mid in mids]
+    arrays = {'hashes': hashes,
+              'has_thumbnail': np.array([bool(r.get('thumbnail'))
+                                         for r in rows])}
+    records = [SEPARATOR.join((r.get(f) or '').replace(SEPARATOR, ' ')
+                              for f in FIELDS) for r in rows]
+    arrays['record_offsets'], arrays['record_data'] = _pack_strings(records)
+    for (rec_type, recs) in recs_by_type.items():
+        lists = [[position[m] for m in recs.get(mid, []) if m]
+                 for mid in mids]
+        offsets = np.zeros(len(mids) + 1, dtype=np.int64)
+        np.cumsum([len(l) for l in lists], out=offsets[1:])
+        arrays[rec_type + '_offsets'] = offsets
+        arrays[rec_type + '_neighbours'] = np.fromiter(
+            (i for l in lists for i in l), dtype=np.int32, count=offsets[-1])
+
+    build_id = '{:d}'.format(int(time.time() * 1e6))
+    build_dir = os.path.join(store_dir, build_id)
+    os.makedirs(build_dir)
+    for (name, array) in arrays.items():
+        np.save(os.path.join(build_dir, name + '.npy'), array)
+    with open(os.path.join(build_dir, 'meta.json'), 'w') as f:
+        json.dump({'build_id': build_id, 'types': sorted(recs_by_type),
+                   'items': len(mids)}, f)
+
+    current = os.path.join(store_dir, 'CURRENT')
+    with open(current + '.tmp', 'w') as f:
+        f.write(build_id)
+    os.replace(current + '.tmp', current)
+
+    builds = sorted(d for d in os.listdir(store_dir)
+                    if os.path.isdir(os.path.join(store_dir, d)))
+    for old in builds[:-keep]:
+        shutil.rmtree(os.path.join(store_dir, old))
+    return build_id
+
+
+class RecStoreBuild(object):
+    """One memory-mapped build of the store."""
+
+    def __init__(self, build_dir):
+        with open(os.path.join(build_dir, 'meta.json'), 'r') as f:
+            meta = json.load(f)
+        self.build_id = meta['build_id']
+
+        def load(name):
+            # Plain ndarray views of the mapping: indexing np.memmap goes
+            # through slow Python-level __getitem__ overrides.
+            return np.asarray(np.load(os.path.join(build_dir, name + '.npy'),
+                                      mmap_mode='r'))
+        self.hashes = load('hashes')
+        self.has_thumbnail = load('has_thumbnail')
+        self.record_offsets = load('record_offsets')
+        # Slicing a memoryview is much cheaper than slicing an array
+        self.record_data = memoryview(load('record_data'))
+        self.recs = [(t, load(t + '_offsets'), load(t + '_neighbours'))
+                     for t in meta['types']]
+
+    def records(self, positions):
+        """Dicts of FIELDS for an array of item positions."""
+        starts = self.record_offsets[positions].tolist()
+        ends = self.record_offsets[positions + 1].tolist()
+        data = self.record_data
+        return [dict(zip(FIELDS, [v or None for v in
+                                  str(data[start:end], 'utf-8')
+                                  .split(SEPARATOR)]))
+                for (start, end) in zip(starts, ends)]
+
+    def position(self, mid):
+        h = mid_hash(mid)
+        i = int(self.hashes.searchsorted(np.uint64(h)))
+        if i == self.hashes.shape[0] or int(self.hashes[i]) != h:
+            return None
+        return i
+
+    def get_page_data(self, mid):
+        """Same return values as helpers.get_page_data."""
+        i = self.position(mid) if mid else None
+        if i is None or not self.has_thumbnail[i]:
+            return None, None
+        mid_data = self.records(np.array([i]))[0]
+        if mid_data['mid'] != mid:
+            return None, None
+        # Fetch the records of every type's neighbours in one go
+        types, counts, positions = [], [], []
+        for (rec_type, offsets, neighbours) in self.recs:
+            start, stop = offsets[i:i + 2].tolist()
+            these = neighbours[start:stop]
+            these = these[self.has_thumbnail[these]]
+            if these.shape[0]:
+                types.append(rec_type)
+                counts.append(these.shape[0])
+                positions.append(these)
+        rec_data = {}
+        if positions:
+            records = self.records(np.concatenate(positions))
+            start = 0
+            for (rec_type, count) in zip(types, counts):
+                rec_data[rec_type] = records[start:start + count]
+                start += count
+        if not rec_data:
+            return None, None
+        return mid_data, rec_data
+
+
+class RecStore(object):
+    """Serves the latest published build in store_dir."""
+
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        self.lock = threading.Lock()
+        self.current = None
+        self.current_version = None
+
+    def version(self):
+        st = os.stat(os.path.join(self.store_dir, 'CURRENT'))
+        return (st.st_ino, st.st_mtime_ns)
+
+    def build(self):
+        version = self.version()
+        with self.lock:
+            if self.current is None or version != self.current_version:
+                with open(os.path.join(self.store_dir, 'CURRENT')) as f:
+                    build_id = f.read().strip()
+                self.current = RecStoreBuild(os.path.join(self.store_dir,
+                                                          build_id))
+                self.current_version = version
+            return self.current
+
+    def get_page_data(self, mid):
+        return self.build().get_page_data(mid)
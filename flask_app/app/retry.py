@@ -0,0 +1,83 @@
+"""
+Retrying, rate limited HTTP requests for the update_mids task.
+
+A trimmed copy of fetch.py from the crawlers in the repository root, so that
+the app does not depend on modules outside its own package.
+"""
+
+import random
+import threading
+import time
+
+import requests
+
+
+TRANSIENT_STATUS = {429, 500, 502, 503, 504}
+
+
+class TransientError(Exception):
+    """Request failed in a way that is worth retrying."""
+
+
+class TokenBucket(object):
+    """Thread-safe token bucket allowing rate requests per second.
+
+    A rate of None or 0 disables limiting.
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.capacity = burst or max(1, rate or 1)
+        self.tokens = self.capacity
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self):
+        """Take a token. Returns seconds to wait before the token is valid."""
+        if not self.rate:
+            return 0.
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity,
+                              self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            self.tokens -= 1
+            if self.tokens >= 0:
+                return 0.
+            return -self.tokens / self.rate
+
+    def acquire(self):
+        time.sleep(self.reserve())
+
+
+def backoff_sleep(attempt, backoff):
+    """Exponential backoff with jitter."""
+    time.sleep(backoff * 2 ** attempt * (1 + random.random()))
+
+
+def get_response(session, url, params=None, limiter=None, retries=5,
+                 backoff=0.5, timeout=30, **kwargs):
+    """GET url, retrying connection errors, timeouts and 429/5xx responses.
+
+    Raises the last error once retries are exhausted, and raises
+    immediately for any other unsuccessful status code.
+    """
+    for attempt in range(retries + 1):
+        if limiter is not None:
+            limiter.acquire()
+        try:
+            response = session.get(url, params=params, timeout=timeout,
+                                   **kwargs)
+            if response.status_code in TRANSIENT_STATUS:
+                raise TransientError('{} returned {}'
+                                     .format(response.url,
+                                             response.status_code))
+        except (requests.ConnectionError, requests.Timeout,
+                TransientError):
+            if attempt == retries:
+                raise
+            backoff_sleep(attempt, backoff)
+            continue
+        if response.status_code != 304:
+            response.raise_for_status()
+        return response
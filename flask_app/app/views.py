@@ -1,48 +1,184 @@
-from flask import render_template, request
-import sqlite3
+import hashlib
+
+from flask import g, jsonify, make_response, render_template, request
 
 from app import app
-from .helpers import (get_mid_names, parse_mid, get_mid_data_from_db,
-                      get_recommendations)
+from .ann import ANNIndex, index_version
+from .database import ReadOnlyDatabase
+from .recstore import RecStore
+from .helpers import (ModelNameIndex, RenderCache, get_mid_names,
+                      get_page_data, parse_mid)
+
+
+ANN_INDEX = None
+DATABASE = None
+MODEL_NAMES = None
+MODEL_NAMES_VERSION = None
+REC_STORE = None
+RENDER_CACHE = None
+NOT_MODIFIED = 0
 
 
 def connect_db():
-    return sqlite3.connect(app.config['DATABASE'])
+    """
+    This request's read-only connection to the current database build. The
+    connection is shared by every request of the worker until a new build
+    is published.
+    """
+    global DATABASE
+    if DATABASE is None:
+        DATABASE = ReadOnlyDatabase(app.config['DATABASE'],
+                                    mmap_size=app.config['SQLITE_MMAP_SIZE'],
+                                    cache_size=app.config['SQLITE_CACHE_SIZE'])
+    if 'db' not in g:
+        g.db = DATABASE.acquire()
+    return g.db
 
 
-@app.route('/')
-@app.route('/index')
-def index():
+@app.teardown_appcontext
+def release_db(exception):
+    conn = g.pop('db', None)
+    if conn is not None:
+        DATABASE.release(conn)
+
+
+def get_ann_index():
+    """
+    Memory-map the configured ANN index, once per worker and again whenever
+    a new build of it is published.
+    """
+    global ANN_INDEX
+    dirname = app.config['ANN_INDEX']
+    if dirname and (ANN_INDEX is None
+                    or index_version(dirname) != ANN_INDEX.version):
+        ANN_INDEX = ANNIndex(dirname, n_probe=app.config['ANN_PROBES'])
+    return ANN_INDEX
+
+
+def get_rec_store():
+    """Memory-mapped recommendation store, if that backend is configured."""
+    global REC_STORE
+    if REC_STORE is None and app.config['RECS_BACKEND'] == 'mmap':
+        REC_STORE = RecStore(app.config['RECSTORE_DIR'])
+    return REC_STORE
+
+
+def get_model_names():
+    """
+    Searchable model names, loaded once per worker and rebuilt whenever a
+    new database build is published.
+    """
+    global MODEL_NAMES, MODEL_NAMES_VERSION
     conn = connect_db()
-    mid_names = get_mid_names(conn)
-    mid = parse_mid(request)
+    version = DATABASE.conn_version
+    if MODEL_NAMES is None or version != MODEL_NAMES_VERSION:
+        MODEL_NAMES = ModelNameIndex(get_mid_names(conn))
+        MODEL_NAMES_VERSION = version
+    return MODEL_NAMES
 
-    try:
-        mid_data = get_mid_data_from_db([mid], conn)[0]
-        recs = get_recommendations(mid, conn)
-        rec_data = {}
-        for (k, v) in recs.items():
-            this_data = get_mid_data_from_db(v, conn)
-            if this_data:
-                rec_data[k] = this_data
-        not_found = False
-    except:
+
+@app.route('/models')
+def models():
+    """Typeahead source: models whose name starts with ?q=."""
+    limit = min(request.args.get('limit', 10, type=int), 50)
+    return jsonify(get_model_names().search(request.args.get('q', ''),
+                                            limit=limit))
+
+
+def data_version():
+    """
+    Id of the database or recstore build the index pages come from, plus
+    the ANN index build if the wrmf recs are computed from one.
+    """
+    rec_store = get_rec_store()
+    if rec_store is not None:
+        return rec_store.build().build_id
+    connect_db()
+    version = [DATABASE.conn_version]
+    ann_index = get_ann_index()
+    if ann_index is not None:
+        version.append(ann_index.version)
+    return '-'.join('{:x}'.format(v) for part in version for v in part)
+
+
+def render_index(mid, has_args):
+    """
+    Look up and render an index page.
+
+    Returns
+    -------
+    page : str
+    found : bool
+        Whether mid has data and recommendations.
+    """
+    rec_store = get_rec_store()
+    if rec_store is not None:
+        mid_data, rec_data = rec_store.get_page_data(mid)
+    else:
+        mid_data, rec_data = get_page_data(mid, connect_db(),
+                                           ann_index=get_ann_index(),
+                                           N=app.config['ANN_N'])
+    not_found = mid_data is None
+    if not_found:
         mid = None
-        mid_data = None
-        rec_data = None
-        not_found = True
 
-    if not request.args:
+    if not has_args:
         not_found = False
 
-    return render_template('index.html',
+    page = render_template('index.html',
         title='Rec-a-Sketch',
         mid=mid,
         mid_data=mid_data,
         rec_data=rec_data,
-        mid_and_name=mid_names,
         not_found=not_found
     )
+    return page, mid_data is not None
+
+
+def get_render_cache():
+    """This worker's LRU cache of rendered index pages."""
+    global RENDER_CACHE
+    if RENDER_CACHE is None:
+        RENDER_CACHE = RenderCache(app.config['RENDER_CACHE_SIZE'])
+    return RENDER_CACHE
+
+
+@app.route('/')
+@app.route('/index')
+def index():
+    global NOT_MODIFIED
+    mid = parse_mid(request)
+    has_args = bool(request.args)
+    key = (data_version(), mid, has_args)
+    etag = hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+
+    if request.if_none_match.contains(etag):
+        NOT_MODIFIED += 1
+        response = make_response('', 304)
+    else:
+        cache = get_render_cache()
+        page = cache.get(key)
+        if page is None:
+            page, found = render_index(mid, has_args)
+            # Arbitrary ?mid= values must not fill up the cache
+            if found or mid is None:
+                cache.put(key, page)
+        response = make_response(page)
+    response.set_etag(etag)
+    response.cache_control.public = True
+    response.cache_control.max_age = app.config['RENDER_CACHE_MAX_AGE']
+    return response
+
+
+@app.route('/cache_stats')
+def cache_stats():
+    """Render cache counters of the worker answering this request."""
+    cache = get_render_cache()
+    response = jsonify(hits=cache.hits, misses=cache.misses,
+                       size=len(cache.pages), maxsize=cache.maxsize,
+                       not_modified=NOT_MODIFIED)
+    response.cache_control.no_store = True
+    return response
 
 @app.route('/about')
 def about():
@@ -1,5 +1,10 @@
-import scipy.sparse as sp
+import os
+
 import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+
+import storage
 
 
 def threshold_interactions_df(df, row_name, col_name, row_min, col_min):
@@ -50,27 +55,26 @@ def threshold_interactions_df(df, row_name, col_name, row_min, col_min):
 
     """
 
-    n_rows = df[row_name].unique().shape[0]
-    n_cols = df[col_name].unique().shape[0]
+    row_codes, _ = pd.factorize(df[row_name])
+    col_codes, _ = pd.factorize(df[col_name])
+
+    n_rows = np.unique(row_codes).shape[0]
+    n_cols = np.unique(col_codes).shape[0]
     sparsity = float(df.shape[0]) / float(n_rows*n_cols) * 100
     print('Starting interactions info')
     print('Number of rows: {}'.format(n_rows))
     print('Number of cols: {}'.format(n_cols))
     print('Sparsity: {:4.3f}%'.format(sparsity))
 
-    done = False
-    while not done:
-        starting_shape = df.shape[0]
-        col_counts = df.groupby(row_name)[col_name].count()
-        df = df[~df[row_name].isin(col_counts[col_counts < col_min].index.tolist())]
-        row_counts = df.groupby(col_name)[row_name].count()
-        df = df[~df[col_name].isin(row_counts[row_counts < row_min].index.tolist())]
-        ending_shape = df.shape[0]
-        if starting_shape == ending_shape:
-            done = True
-
-    n_rows = df[row_name].unique().shape[0]
-    n_cols = df[col_name].unique().shape[0]
+    # Rows are limited by col_min (distinct columns per row) and vice versa.
+    mask, stats = kcore_mask(row_codes, col_codes, col_min, row_min)
+    for s in stats:
+        print(('Round {round}: dropped {rows_dropped} rows, {cols_dropped} '
+               'cols, {interactions_left} interactions left').format(**s))
+    df = df[mask]
+
+    n_rows = np.unique(row_codes[mask]).shape[0]
+    n_cols = np.unique(col_codes[mask]).shape[0]
     sparsity = float(df.shape[0]) / float(n_rows*n_cols) * 100
     print('Ending interactions info')
     print('Number of rows: {}'.format(n_rows))
@@ -79,6 +83,147 @@ def threshold_interactions_df(df, row_name, col_name, row_min, col_min):
     return df
 
 
+def _group_positions(codes, n_groups):
+    """Sort interaction positions by group code.
+
+    Returns the permutation of interaction positions along with a CSR-style
+    indptr such that order[indptr[g]:indptr[g+1]] are the positions of every
+    interaction belonging to group g.
+    """
+    order = np.argsort(codes, kind='mergesort')
+    indptr = np.zeros(n_groups + 1, dtype=np.int64)
+    np.cumsum(np.bincount(codes, minlength=n_groups), out=indptr[1:])
+    return order, indptr
+
+
+def _gather_positions(order, indptr, groups):
+    """Positions of all interactions belonging to any of groups."""
+    starts = indptr[groups]
+    lengths = indptr[groups + 1] - starts
+    total = lengths.sum()
+    if total == 0:
+        return np.empty(0, dtype=order.dtype)
+    shift = np.repeat(starts - (np.cumsum(lengths) - lengths), lengths)
+    return order[shift + np.arange(total)]
+
+
+def kcore_mask(row_codes, col_codes, row_min, col_min):
+    """Find interactions which survive iterative minimum-degree filtering.
+
+    Row entities with fewer than row_min interactions are dropped, then
+    column entities with fewer than col_min interactions are dropped, and the
+    two steps are repeated until nothing changes. Degrees are updated
+    incrementally so that each round only re-checks entities which lost an
+    interaction in the previous step.
+
+    Parameters
+    ----------
+    row_codes : array of int
+        Integer code (0, ..., n_rows - 1) of the row entity of each
+        interaction, e.g. the output of pd.factorize.
+    col_codes : array of int
+        Same as row_codes but for the column entity.
+    row_min : int
+        Minimum number of interactions a row entity must have.
+    col_min : int
+        Minimum number of interactions a column entity must have.
+
+    Returns
+    -------
+    mask : array of bool
+        True for every interaction which survives the filtering.
+    stats : list of dict
+        One dict per round with the number of row and column entities
+        dropped and the number of interactions left after the round.
+    """
+    row_codes = np.asarray(row_codes, dtype=np.int64)
+    col_codes = np.asarray(col_codes, dtype=np.int64)
+    n_rows = row_codes.max() + 1 if row_codes.size else 0
+    n_cols = col_codes.max() + 1 if col_codes.size else 0
+
+    mask = np.ones(row_codes.shape[0], dtype=bool)
+    row_deg = np.bincount(row_codes, minlength=n_rows)
+    col_deg = np.bincount(col_codes, minlength=n_cols)
+    row_order, row_indptr = _group_positions(row_codes, n_rows)
+    col_order, col_indptr = _group_positions(col_codes, n_cols)
+
+    # Entities whose degree changed since they were last checked.
+    row_check = np.arange(n_rows)
+    col_check = np.arange(n_cols)
+    n_left = mask.sum()
+    stats = []
+    while True:
+        deg = row_deg[row_check]
+        dropped_rows = row_check[(deg > 0) & (deg < row_min)]
+        pos = _gather_positions(row_order, row_indptr, dropped_rows)
+        pos = pos[mask[pos]]
+        mask[pos] = False
+        row_deg[dropped_rows] = 0
+        touched = col_codes[pos]
+        col_deg -= np.bincount(touched, minlength=n_cols)
+        if len(stats):
+            col_check = np.unique(touched)
+
+        deg = col_deg[col_check]
+        dropped_cols = col_check[(deg > 0) & (deg < col_min)]
+        pos_c = _gather_positions(col_order, col_indptr, dropped_cols)
+        pos_c = pos_c[mask[pos_c]]
+        mask[pos_c] = False
+        col_deg[dropped_cols] = 0
+        touched = row_codes[pos_c]
+        row_deg -= np.bincount(touched, minlength=n_rows)
+        row_check = np.unique(touched)
+
+        n_left -= pos.shape[0] + pos_c.shape[0]
+        stats.append({'round': len(stats) + 1,
+                      'rows_dropped': dropped_rows.shape[0],
+                      'cols_dropped': dropped_cols.shape[0],
+                      'interactions_left': int(n_left)})
+        if pos.shape[0] == 0 and pos_c.shape[0] == 0:
+            break
+    return mask, stats
+
+
+def encode_ids(values, ids=None):
+    """Map entity ID's to integer indices.
+
+    Parameters
+    ----------
+    values : array-like
+        ID of the entity for each interaction.
+    ids : array-like, optional
+        Existing mapping from index to ID, e.g. the idx_to_cid array of a
+        trained model. If None, a new mapping is built in order of first
+        appearance.
+
+    Returns
+    -------
+    codes : array of int
+        Index of each value. Values missing from an existing mapping get -1.
+    ids : array
+        Maps index to ID.
+    """
+    if ids is None:
+        codes, ids = pd.factorize(values)
+        return codes, np.asarray(ids)
+    ids = np.asarray(ids)
+    codes = pd.Index(ids).get_indexer(values)
+    return codes, ids
+
+
+def ids_to_dicts(ids):
+    """Dict view of an index to ID array.
+
+    Returns
+    -------
+    id_to_idx : dict
+    idx_to_id : dict
+    """
+    idx_to_id = dict(enumerate(np.asarray(ids).tolist()))
+    id_to_idx = {v: k for (k, v) in idx_to_id.items()}
+    return id_to_idx, idx_to_id
+
+
 def get_df_matrix_mappings(df, row_name, col_name):
     """Map entities in interactions df to row and column indices
 
@@ -101,25 +246,15 @@ def get_df_matrix_mappings(df, row_name, col_name):
         Same as rid_to_idx but for column ID's
     idx_to_cid : dict
     """
-
-
-    # Create mappings
-    rid_to_idx = {}
-    idx_to_rid = {}
-    for (idx, rid) in enumerate(df[row_name].unique().tolist()):
-        rid_to_idx[rid] = idx
-        idx_to_rid[idx] = rid
-
-    cid_to_idx = {}
-    idx_to_cid = {}
-    for (idx, cid) in enumerate(df[col_name].unique().tolist()):
-        cid_to_idx[cid] = idx
-        idx_to_cid[idx] = cid
-
+    _, row_ids = encode_ids(df[row_name])
+    _, col_ids = encode_ids(df[col_name])
+    rid_to_idx, idx_to_rid = ids_to_dicts(row_ids)
+    cid_to_idx, idx_to_cid = ids_to_dicts(col_ids)
     return rid_to_idx, idx_to_rid, cid_to_idx, idx_to_cid
 
 
-def df_to_matrix(df, row_name, col_name):
+def df_to_matrix(df, row_name, col_name, row_ids=None, col_ids=None,
+                 as_dicts=True):
     """Take interactions dataframe and convert to a sparse matrix
 
     Parameters
@@ -127,6 +262,13 @@ def df_to_matrix(df, row_name, col_name):
     df : DataFrame
     row_name : str
     col_name : str
+    row_ids : array-like, optional
+        Existing index to row ID mapping to encode against. Interactions
+        with row ID's outside of the mapping are dropped.
+    col_ids : array-like, optional
+        Same as row_ids but for column ID's.
+    as_dicts : bool
+        Return the mappings as dicts (the default) or as arrays.
 
     Returns
     -------
@@ -136,25 +278,33 @@ def df_to_matrix(df, row_name, col_name):
     cid_to_idx : dict
     idx_to_cid : dict
 
-    """
-
-    rid_to_idx, idx_to_rid,\
-        cid_to_idx, idx_to_cid = get_df_matrix_mappings(df,
-                                                        row_name,
-                                                        col_name)
+    If as_dicts is False, then only the index to ID arrays are returned:
 
-    def map_ids(row, mapper):
-        return mapper[row]
+    interactions : sparse csr matrix
+    row_ids : array
+    col_ids : array
 
-    I = df[row_name].apply(map_ids, args=[rid_to_idx]).as_matrix()
-    J = df[col_name].apply(map_ids, args=[cid_to_idx]).as_matrix()
+    """
+    I, row_ids = encode_ids(df[row_name], row_ids)
+    J, col_ids = encode_ids(df[col_name], col_ids)
+    known = (I >= 0) & (J >= 0)
+    if not known.all():
+        print('Dropping {} interactions with unmapped ids'
+              .format((~known).sum()))
+        I, J = I[known], J[known]
     V = np.ones(I.shape[0])
-    interactions = sp.coo_matrix((V, (I, J)), dtype=np.float64)
-    interactions = interactions.tocsr()
+    interactions = sp.csr_matrix((V, (I, J)),
+                                 shape=(row_ids.shape[0], col_ids.shape[0]),
+                                 dtype=np.float64)
+    if not as_dicts:
+        return interactions, row_ids, col_ids
+    rid_to_idx, idx_to_rid = ids_to_dicts(row_ids)
+    cid_to_idx, idx_to_cid = ids_to_dicts(col_ids)
     return interactions, rid_to_idx, idx_to_rid, cid_to_idx, idx_to_cid
 
 
-def train_test_split(interactions, split_count, fraction=None):
+def train_test_split(interactions, split_count, fraction=None, seed=None,
+                     mode='random', timestamps=None, cutoff=None):
     """
     Split recommendation data into train and test sets
 
@@ -169,37 +319,263 @@ def train_test_split(interactions, split_count, fraction=None):
         Fraction of users to split off some of their
         interactions into test set. If None, then all
         users are considered.
+    seed : int or np.random.Generator, optional
+        Seed for sampling users and test interactions.
+    mode : str
+        How test interactions are chosen for each user:
+        'random' - split_count interactions sampled uniformly.
+        'last' - the split_count most recent interactions.
+        'time' - every interaction at or after cutoff.
+    timestamps : scipy.sparse matrix, optional
+        Time of each interaction with the same sparsity pattern as
+        interactions. Required for the 'last' and 'time' modes.
+    cutoff : float, optional
+        Timestamp at which the test period starts for the 'time' mode.
+
+    Users with fewer than split_count interactions (2 * split_count if
+    fraction is given) are never split and are not part of user_index.
+
+    Returns
+    -------
+    train : scipy.sparse csr matrix
+    test : scipy.sparse csr matrix
+    user_index : array of int
+        Users which had interactions moved into the test set.
     """
-    # Note: likely not the fastest way to do things below.
-    train = interactions.copy().tocoo()
-    test = sp.lil_matrix(train.shape)
+    if mode not in ('random', 'last', 'time'):
+        raise ValueError('Unknown split mode {}'.format(mode))
+    if mode != 'random' and timestamps is None:
+        raise ValueError('Split mode {} requires timestamps'.format(mode))
+    if mode == 'time' and cutoff is None:
+        raise ValueError('Split mode time requires a cutoff')
+
+    rng = np.random.default_rng(seed)
+    interactions = sp.csr_matrix(interactions, copy=True)
+    interactions.sum_duplicates()
+    indptr = interactions.indptr
+    n_users = interactions.shape[0]
+    counts = np.diff(indptr)
 
     if fraction:
         try:
-            user_index = np.random.choice(
-                np.where(np.bincount(train.row) >= split_count * 2)[0],
+            user_index = rng.choice(
+                np.where(counts >= split_count * 2)[0],
                 replace=False,
-                size=np.int64(np.floor(fraction * train.shape[0]))
-            ).tolist()
-        except:
+                size=np.int64(np.floor(fraction * n_users))
+            )
+        except ValueError:
             print(('Not enough users with > {} '
                   'interactions for fraction of {}')\
                   .format(2*split_count, fraction))
             raise
     else:
-        user_index = range(train.shape[0])
+        user_index = np.where(counts >= split_count)[0]
+    user_index = np.sort(user_index)
+
+    selected = np.zeros(n_users, dtype=bool)
+    selected[user_index] = True
+    rows = np.repeat(np.arange(n_users), counts)
+    in_split = selected[rows]
+
+    if mode == 'time':
+        times = _aligned_data(timestamps, interactions)
+        test_mask = in_split & (times >= cutoff)
+    else:
+        if mode == 'random':
+            keys = rng.random(rows.shape[0])
+        else:
+            # Most recent first
+            keys = -_aligned_data(timestamps, interactions)
+        # Rank every interaction within its user's row by key.
+        order = np.lexsort((keys, rows))
+        rank = np.empty(rows.shape[0], dtype=np.int64)
+        rank[order] = np.arange(rows.shape[0]) - indptr[rows[order]]
+        test_mask = in_split & (rank < split_count)
+
+    train = _mask_csr(interactions, rows, ~test_mask)
+    test = _mask_csr(interactions, rows, test_mask)
+    if mode == 'time':
+        user_index = user_index[np.diff(test.indptr)[user_index] > 0]
+    return train, test, user_index
+
+
+def _aligned_data(values, interactions):
+    """Data of values in the same order as the nonzeros of interactions."""
+    values = sp.csr_matrix(values, copy=True)
+    values.sum_duplicates()
+    if (values.nnz != interactions.nnz
+            or not np.array_equal(values.indptr, interactions.indptr)
+            or not np.array_equal(values.indices, interactions.indices)):
+        raise ValueError('timestamps must have the same sparsity pattern '
+                         'as interactions')
+    return values.data
+
+
+def _mask_csr(matrix, rows, keep):
+    """Keep the nonzeros of a canonical csr matrix where keep is True."""
+    indptr = np.zeros(matrix.shape[0] + 1, dtype=matrix.indptr.dtype)
+    np.cumsum(np.bincount(rows[keep], minlength=matrix.shape[0]),
+              out=indptr[1:])
+    return sp.csr_matrix((matrix.data[keep], matrix.indices[keep], indptr),
+                         shape=matrix.shape)
+
+
+def load_likes(filename):
+    """Load the mid and uid columns of anonymized likes.
+
+    filename may be the psv or its Parquet/Arrow conversion from storage.py.
+    """
+    return storage.read_table(filename, columns=['mid', 'uid'])
+
+
+def load_interactions(filename, row_min, col_min):
+    """Load likes, threshold them, and build the user x item matrix.
 
-    train = train.tolil()
+    row_min and col_min are passed straight to threshold_interactions_df
+    with users as rows and mids as columns.
 
-    for user in user_index:
-        test_interactions = np.random.choice(interactions.getrow(user).indices,
-                                        size=split_count,
-                                        replace=False)
-        train[user, test_interactions] = 0.
-        # These are just 1.0 right now
-        test[user, test_interactions] = interactions[user, test_interactions]
+    Returns
+    -------
+    interactions : sparse csr matrix
+    uids : array
+        Maps row index to uid.
+    mids : array
+        Maps column index to mid.
+    """
+    likes = load_likes(filename)
+    likes = threshold_interactions_df(likes, 'uid', 'mid', row_min, col_min)
+    return df_to_matrix(likes, 'uid', 'mid', as_dicts=False)
+
+
+def top_k(scores, k):
+    """Column indices of the k largest scores in each row, best first."""
+    k = min(k, scores.shape[1])
+    part = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    part_scores = np.take_along_axis(scores, part, axis=1)
+    order = np.argsort(-part_scores, axis=1, kind='stable')
+    return np.take_along_axis(part, order, axis=1)
+
+
+def factor_neighbours(factors, N, block_size=1024, rows=None):
+    """Top N cosine neighbours of each row of factors, excluding itself.
+
+    Scores are computed block_size rows at a time so that only a
+    block_size x n_rows slab of the similarity matrix is ever in memory.
+    If rows is given, only the neighbours of those rows are computed, in
+    that order.
+    """
+    norms = np.linalg.norm(factors, axis=1)
+    norms[norms == 0] = 1.
+    normed = factors / norms[:, np.newaxis]
+    n = normed.shape[0]
+    if rows is None:
+        rows = np.arange(n)
+    N = min(N, n - 1)
+    neighbours = np.empty((len(rows), N), dtype=np.int32)
+    for start in range(0, len(rows), block_size):
+        block = rows[start:start + block_size]
+        scores = normed[block] @ normed.T
+        scores[np.arange(len(block)), block] = -np.inf
+        neighbours[start:start + len(block)] = top_k(scores, N)
+    return neighbours
+
+
+def write_recs(filename, neighbours, ids, rows=None):
+    """Write recommendations in the mid|rec1|rec2|... format of load_recs.
+
+    Parameters
+    ----------
+    filename : str
+    neighbours : array of int
+        Row i holds the indices of the recommendations for item i, best
+        first. Negative indices are padding and are skipped.
+    ids : array
+        Maps item index to mid.
+    rows : array of int, optional
+        Item index of each row of neighbours, if it only holds some items.
+    """
+    ids = np.asarray(ids)
+    if rows is None:
+        rows = np.arange(len(neighbours))
+    with open(filename, 'w') as f:
+        for (idx, row) in zip(rows, neighbours):
+            line = [ids[idx]] + ids[row[row >= 0]].tolist()
+            f.write('|'.join(str(x) for x in line) + '\n')
 
 
-    # Test and training are truly disjoint
-    assert(train.multiply(test).nnz == 0)
-    return train.tocsr(), test.tocsr(), user_index
\ No newline at end of file
+def thumbnail_mask(mid_data_filename, ids):
+    """Boolean mask over item indices of the mids that have a thumbnail.
+
+    Parameters
+    ----------
+    mid_data_filename : str
+        mid_data file written by flask_app/app/helpers.py.
+    ids : array
+        Maps item index to mid.
+    """
+    mid_data = pd.read_csv(mid_data_filename, sep='|', quotechar='\\',
+                           usecols=['mid', 'thumbnail'])
+    with_thumbnail = mid_data.loc[mid_data['thumbnail'].notnull(), 'mid']
+    return pd.Index(ids).isin(with_thumbnail)
+
+
+def filter_neighbours(neighbours, valid, N):
+    """First N valid entries of each row of neighbours, keeping their order.
+
+    Parameters
+    ----------
+    neighbours : array of int
+        Candidate item indices per row, best first. Negative indices are
+        padding.
+    valid : array of bool
+        Mask over item indices, e.g. from thumbnail_mask.
+    N : int
+
+    Returns
+    -------
+    filtered : array of int32
+        n_rows x N, padded with -1 where a row has fewer than N valid
+        candidates.
+    """
+    neighbours = np.asarray(neighbours)
+    if neighbours.shape[1] < N:
+        padding = np.full((neighbours.shape[0], N - neighbours.shape[1]), -1)
+        neighbours = np.hstack([neighbours, padding])
+    keep = (neighbours >= 0) & valid[np.maximum(neighbours, 0)]
+    keep &= np.cumsum(keep, axis=1) <= N
+    # A stable sort of ~keep moves kept candidates to the front in order.
+    order = np.argsort(~keep, axis=1, kind='stable')[:, :N]
+    filtered = np.take_along_axis(neighbours, order, axis=1).astype(np.int32)
+    filtered[~np.take_along_axis(keep, order, axis=1)] = -1
+    return filtered
+
+
+def get_recs_filename(config, rec_type):
+    """Location of the recs file that the flask app loads for rec_type."""
+    return os.path.join('flask_app', 'app', config['db_dir'],
+                        config['db_files']['recs'][rec_type])
+
+
+def get_mid_data_filename(config):
+    """Location of the flask app's mid_data file."""
+    return os.path.join('flask_app', 'app', config['db_dir'],
+                        config['db_files']['mid_data_file'])
+
+
+def export_recs(config, filename, neighbours, ids, N, rows=None):
+    """
+    Write the first N recommendations per item that the site can display,
+    i.e. that have a thumbnail in the app's mid_data. If there is no
+    mid_data yet, the first N candidates are written unfiltered. rows is
+    passed on to write_recs.
+    """
+    mid_data_filename = get_mid_data_filename(config)
+    if os.path.isfile(mid_data_filename):
+        valid = thumbnail_mask(mid_data_filename, ids)
+        print('{} of {} models have thumbnails'.format(valid.sum(),
+                                                       len(valid)))
+    else:
+        print('No {}, not filtering recs'.format(mid_data_filename))
+        valid = np.ones(len(ids), dtype=bool)
+    write_recs(filename, filter_neighbours(neighbours, valid, N), ids,
+               rows=rows)
@@ -0,0 +1,231 @@
+"""
+Fold newly crawled likes into a trained WRMF model instead of retraining.
+
+Starting from the model saved by wrmf.py --model-dir:
+
+1. New uids and mids are appended to the id mappings and the new likes are
+   added to the saved interactions.
+2. Users and items with new likes are re-solved exactly with the other
+   side's factors held fixed (one ALS half-step restricted to those rows).
+   New users and items start from zero.
+3. Only items whose neighbourhood may have changed get their neighbours
+   recomputed: items whose factors changed, items that had one of those as
+   a neighbour, and items for which one of those now scores above their
+   current last neighbour.
+4. The full recs file is rewritten and the recs of the affected items are
+   also written to <recs file>.delta, which
+   flask_app/app/helpers.py --task upsert_recs applies to the database.
+
+    python incremental.py config.yml model data/new_likes.psv
+"""
+
+import argparse
+import os
+import time
+
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+import yaml
+
+import helpers
+import wrmf
+
+
+def extend_ids(ids, values):
+    """ids with the values that are not in ids yet appended."""
+    codes, _ = helpers.encode_ids(values, ids=ids)
+    new = pd.unique(np.asarray(values)[codes < 0])
+    return np.concatenate([np.asarray(ids), np.asarray(new).astype(str)])
+
+
+def add_likes(interactions, likes, uids, mids):
+    """
+    Add a DataFrame of new (mid, uid) likes to interactions.
+
+    Returns
+    -------
+    interactions : sparse csr matrix
+        Resized to the extended ids.
+    new : sparse csr matrix
+        Only the likes that were not in interactions before.
+    uids, mids : arrays
+        Extended id mappings. Existing ids keep their index.
+    """
+    uids = extend_ids(uids, likes['uid'].values)
+    mids = extend_ids(mids, likes['mid'].values)
+    new, _, _ = helpers.df_to_matrix(likes, 'uid', 'mid', row_ids=uids,
+                                     col_ids=mids, as_dicts=False)
+    new.data[:] = 1.
+    interactions = sp.csr_matrix(interactions, dtype=np.float64)
+    interactions.resize(new.shape)
+    new = new - new.multiply(interactions > 0)
+    new.eliminate_zeros()
+    return (interactions + new).tocsr(), new.tocsr(), uids, mids
+
+
+def _grow(factors, n):
+    """factors with zero rows appended up to n rows."""
+    grown = np.zeros((n, factors.shape[1]), dtype=factors.dtype)
+    grown[:factors.shape[0]] = factors
+    return grown
+
+
+def fold_in(interactions, new, user_factors, item_factors, alpha=40.,
+            regularization=0.01, sweeps=2):
+    """
+    Re-solve the users and items that have new likes.
+
+    Returns
+    -------
+    user_factors, item_factors : arrays
+        Grown to the shape of interactions.
+    changed_items : array of int
+    """
+    Cui = interactions.astype(np.float32)
+    Cui.data = 1. + alpha * Cui.data
+    Ciu = Cui.T.tocsr()
+    X = _grow(user_factors, Cui.shape[0])
+    Y = _grow(item_factors, Cui.shape[1])
+    new = new.tocoo()
+    changed_users = np.unique(new.row)
+    changed_items = np.unique(new.col)
+    print('Folding in {} users and {} items'.format(len(changed_users),
+                                                    len(changed_items)))
+    for _ in range(sweeps):
+        X[changed_users] = wrmf.solve_rows(Cui, Y, regularization,
+                                           changed_users)
+        Y[changed_items] = wrmf.solve_rows(Ciu, X, regularization,
+                                           changed_items)
+    return X, Y, changed_items
+
+
+def affected_items(item_factors, neighbours, changed, block_size=1024):
+    """
+    Items whose top neighbours may differ after the factors of the changed
+    items were updated.
+
+    Parameters
+    ----------
+    item_factors : array
+        Updated factors.
+    neighbours : array of int (n_old_items x K)
+        Neighbours before the update. Items past n_old_items are new.
+    changed : array of int
+    block_size : int
+    """
+    n_items = item_factors.shape[0]
+    n_old = neighbours.shape[0]
+    norms = np.linalg.norm(item_factors, axis=1)
+    norms[norms == 0] = 1.
+    normed = item_factors / norms[:, np.newaxis]
+
+    affected = np.zeros(n_items, dtype=bool)
+    affected[changed] = True
+    affected[n_old:] = True
+    affected[:n_old] |= np.isin(neighbours, changed).any(axis=1)
+    # Unaffected so far means the last neighbour's factors did not change,
+    # so this is still the score a newcomer has to beat.
+    last = np.einsum('ij,ij->i', normed[:n_old], normed[neighbours[:, -1]])
+    normed_changed = normed[changed]
+    for start in range(0, n_old, block_size):
+        stop = min(start + block_size, n_old)
+        best = (normed[start:stop] @ normed_changed.T).max(axis=1,
+                                                           initial=-np.inf)
+        affected[start:stop] |= best > last[start:stop]
+    return np.flatnonzero(affected)
+
+
+def update(model_dir, likes, alpha=None, regularization=None, sweeps=2):
+    """
+    Fold likes into the model in model_dir and update its neighbours.
+
+    alpha and regularization default to the values the model was trained
+    with, as saved by wrmf.save_model.
+
+    Returns
+    -------
+    item_factors : array
+    mids : array
+    neighbours : array of int
+    affected : array of int
+        Items whose neighbours were recomputed.
+    """
+    user_factors, item_factors, uids, mids = wrmf.load_model(model_dir)
+    params = wrmf.load_params(model_dir)
+    if not params:
+        print('No saved training parameters in {}, using the wrmf.py '
+              'defaults unless given'.format(model_dir))
+    if alpha is None:
+        alpha = params.get('alpha', 40.)
+    if regularization is None:
+        regularization = params.get('regularization', 0.01)
+    interactions_file = os.path.join(model_dir, 'interactions.npz')
+    if not os.path.isfile(interactions_file):
+        raise IOError('No {}, retrain with wrmf.py --model-dir'
+                      .format(interactions_file))
+    interactions = sp.load_npz(interactions_file)
+    neighbours_file = os.path.join(model_dir, 'neighbours.npy')
+    if os.path.isfile(neighbours_file):
+        neighbours = np.load(neighbours_file)
+    else:
+        print('No saved neighbours, computing them for the current model')
+        neighbours = helpers.factor_neighbours(item_factors, 60)
+
+    t0 = time.time()
+    interactions, new, uids, mids = add_likes(interactions, likes, uids, mids)
+    print('{} new likes, {} users and {} items in total'
+          .format(new.nnz, len(uids), len(mids)))
+    user_factors, item_factors, changed = fold_in(
+        interactions, new, user_factors, item_factors, alpha=alpha,
+        regularization=regularization, sweeps=sweeps)
+
+    affected = affected_items(item_factors, neighbours, changed)
+    print('Recomputing neighbours of {} items'.format(len(affected)))
+    grown = np.zeros((len(mids), neighbours.shape[1]), dtype=np.int32)
+    grown[:neighbours.shape[0]] = neighbours
+    grown[affected] = helpers.factor_neighbours(item_factors,
+                                                neighbours.shape[1],
+                                                rows=affected)
+    neighbours = grown
+
+    wrmf.save_model(model_dir, user_factors, item_factors, uids, mids,
+                    interactions=interactions, params=params or None)
+    np.save(neighbours_file, neighbours)
+    print('Updated model in {:.1f} seconds'.format(time.time() - t0))
+    return item_factors, mids, neighbours, affected
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Fold new likes into a trained WRMF model')
+    parser.add_argument('config', help='config file with data locations')
+    parser.add_argument('model_dir', help='Output of wrmf.py --model-dir')
+    parser.add_argument('likes', help='New likes, in any format that '
+                                      'helpers.load_likes reads')
+    parser.add_argument('--regularization', default=None, type=float,
+                        help='Defaults to the value the model was trained '
+                             'with')
+    parser.add_argument('--alpha', default=None, type=float,
+                        help='Confidence scaling of likes. Defaults to the '
+                             'value the model was trained with')
+    parser.add_argument('--sweeps', default=2, type=int,
+                        help='Alternating solves of changed users and items')
+    parser.add_argument('--N', default=20, type=int,
+                        help='Number of recommendations per model')
+    parser.add_argument('--output', default=None,
+                        help='Recs file. Defaults to the wrmf file in config')
+
+    args = parser.parse_args()
+    config = yaml.safe_load(open(args.config, 'r'))
+    output = args.output or helpers.get_recs_filename(config, 'wrmf')
+
+    likes = helpers.load_likes(args.likes).astype(str).drop_duplicates()
+    item_factors, mids, neighbours, affected = update(
+        args.model_dir, likes, alpha=args.alpha,
+        regularization=args.regularization, sweeps=args.sweeps)
+    helpers.export_recs(config, output, neighbours, mids, args.N)
+    helpers.export_recs(config, output + '.delta', neighbours[affected], mids,
+                        args.N, rows=affected)
+    print('Wrote recs to {} and {} changed items to {}.delta'
+          .format(output, len(affected), output))
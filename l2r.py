@@ -0,0 +1,331 @@
+"""
+Train a learning-to-rank model with Bayesian Personalized Ranking (BPR) and
+write item-to-item recommendations for the flask app.
+
+Training samples are (user, liked item, random item) triples. They are drawn
+in vectorized batches: a batch of likes is picked uniformly from the CSR
+matrix, negatives are drawn uniformly from all items and redrawn if the user
+liked them. Batches are processed Hogwild style, i.e. several threads update
+the shared factor arrays without any locking.
+
+Items can optionally be described by their categories and tags (see
+content.py). An item's embedding is then its own factors plus the sum of its
+weighted feature factors, as in LightFM, which helps models with few likes.
+"""
+
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import os
+import time
+
+import numpy as np
+import scipy.sparse as sp
+import yaml
+
+import helpers
+
+
+def sample_triples(interactions, keys, size, rng, max_redraws=100):
+    """
+    Vectorized batch of BPR training triples.
+
+    Parameters
+    ----------
+    interactions : sparse csr matrix
+        User x item likes with sorted indices. Users who like every item
+        have no negatives and should be removed first.
+    keys : array of int64
+        Sorted user * n_items + item of every like, for membership tests.
+    size : int
+    rng : np.random.Generator
+    max_redraws : int
+        Rounds of redrawing negatives the user likes. Triples still without
+        a negative after that are dropped, so fewer than size may be
+        returned.
+
+    Returns
+    -------
+    users, positives, negatives : arrays of int
+    """
+    if interactions.nnz == 0:
+        raise ValueError('Cannot sample triples without any interactions')
+    n_items = interactions.shape[1]
+    likes = rng.integers(interactions.nnz, size=size)
+    users = np.searchsorted(interactions.indptr, likes, side='right') - 1
+    positives = interactions.indices[likes]
+    negatives = rng.integers(n_items, size=size)
+    redraw = np.arange(size)
+    for _ in range(max_redraws + 1):
+        query = users[redraw] * n_items + negatives[redraw]
+        found = np.minimum(np.searchsorted(keys, query), keys.size - 1)
+        redraw = redraw[keys[found] == query]
+        if not redraw.size:
+            break
+        negatives[redraw] = rng.integers(n_items, size=redraw.size)
+    if redraw.size:
+        keep = np.ones(size, dtype=bool)
+        keep[redraw] = False
+        return users[keep], positives[keep], negatives[keep]
+    return users, positives, negatives
+
+
+def _scatter_add(target, rows, grads):
+    """target[rows] += grads, summing over repeated rows."""
+    unique, inverse = np.unique(rows, return_inverse=True)
+    S = sp.csr_matrix((np.ones(rows.shape[0], dtype=grads.dtype),
+                       (inverse, np.arange(rows.shape[0]))),
+                      shape=(unique.shape[0], rows.shape[0]))
+    target[unique] += S @ grads
+
+
+class BPR(object):
+    """
+    BPR model with optional item features.
+
+    Parameters
+    ----------
+    n_users : int
+    n_items : int
+    factors : int
+    item_features : sparse csr matrix, optional
+        Item x feature matrix, e.g. from content.feature_matrix.
+    seed : int, optional
+    """
+
+    def __init__(self, n_users, n_items, factors=50, item_features=None,
+                 seed=None):
+        rng = np.random.default_rng(seed)
+        self.user_factors = rng.normal(
+            scale=0.1, size=(n_users, factors)).astype(np.float32)
+        self.item_factors = rng.normal(
+            scale=0.1, size=(n_items, factors)).astype(np.float32)
+        self.item_bias = np.zeros(n_items, dtype=np.float32)
+        self.item_features = None
+        self.feature_factors = None
+        if item_features is not None:
+            self.item_features = sp.csr_matrix(item_features,
+                                               dtype=np.float32)
+            self.feature_factors = np.zeros(
+                (item_features.shape[1], factors), dtype=np.float32)
+
+    def item_embeddings(self, items=None):
+        """Item factors plus their weighted feature factors."""
+        if items is None:
+            items = slice(None)
+        embeddings = self.item_factors[items]
+        if self.item_features is not None:
+            embeddings = (embeddings
+                          + self.item_features[items] @ self.feature_factors)
+        return embeddings
+
+    def sgd_step(self, users, positives, negatives, learning_rate,
+                 regularization):
+        """One SGD update from a batch of triples. Returns the mean loss."""
+        U = self.user_factors[users]
+        Ei = self.item_embeddings(positives)
+        Ej = self.item_embeddings(negatives)
+        x = (np.einsum('ij,ij->i', U, Ei - Ej)
+             + self.item_bias[positives] - self.item_bias[negatives])
+        # d/dx of log(sigmoid(x))
+        g = (1. / (1. + np.exp(x))).astype(np.float32)[:, np.newaxis]
+
+        lr = learning_rate
+        _scatter_add(self.user_factors, users,
+                     lr * (g * (Ei - Ej) - regularization * U))
+        grad_item = g * U
+        _scatter_add(self.item_factors, positives,
+                     lr * (grad_item - regularization
+                           * self.item_factors[positives]))
+        _scatter_add(self.item_factors, negatives,
+                     lr * (-grad_item - regularization
+                           * self.item_factors[negatives]))
+        _scatter_add(self.item_bias, positives,
+                     lr * (g[:, 0] - regularization
+                           * self.item_bias[positives]))
+        _scatter_add(self.item_bias, negatives,
+                     lr * (-g[:, 0] - regularization
+                           * self.item_bias[negatives]))
+        if self.item_features is not None:
+            Fd = self.item_features[positives] - self.item_features[negatives]
+            grad = Fd.T.tocsr() @ grad_item
+            touched = np.unique(Fd.indices)
+            self.feature_factors[touched] += lr * (
+                grad[touched] - regularization
+                * self.feature_factors[touched])
+        return float(np.mean(np.logaddexp(0., -x)))
+
+    def scores(self, users):
+        """Scores of every item for a batch of users."""
+        return (self.user_factors[users] @ self.item_embeddings().T
+                + self.item_bias)
+
+
+def precision_at_k(model, train, test, k=10, users=None):
+    """Mean precision@k of model on test, ignoring items liked in train."""
+    if users is None:
+        users = np.flatnonzero(np.diff(test.indptr))
+    hits = 0
+    for start in range(0, users.shape[0], 1024):
+        batch = users[start:start + 1024]
+        scores = model.scores(batch)
+        seen = train[batch].tocoo()
+        scores[seen.row, seen.col] = -np.inf
+        top = helpers.top_k(scores, k)
+        hits += np.take_along_axis(test[batch].toarray(), top, axis=1).sum()
+    return hits / float(k * users.shape[0])
+
+
+def _hogwild_worker(model, interactions, keys, n_samples, batch_size,
+                    learning_rate, regularization, rng):
+    losses = []
+    for start in range(0, n_samples, batch_size):
+        size = min(batch_size, n_samples - start)
+        triples = sample_triples(interactions, keys, size, rng)
+        if not triples[0].size:
+            # Every triple was dropped for lack of a negative
+            continue
+        losses.append(model.sgd_step(*triples, learning_rate,
+                                     regularization))
+    return np.mean(losses) if losses else 0.
+
+
+def train(interactions, factors=50, learning_rate=0.05, regularization=0.001,
+          epochs=20, batch_size=1024, workers=1, item_features=None,
+          validation=None, k=10, seed=None):
+    """Fit BPR to an implicit feedback matrix with Hogwild SGD.
+
+    Parameters
+    ----------
+    interactions : sparse csr matrix
+        User x item interactions, e.g. from helpers.df_to_matrix.
+    factors : int
+        Number of latent factors.
+    learning_rate : float
+    regularization : float
+        L2 penalty on the factors.
+    epochs : int
+        Each epoch draws as many triples as there are interactions.
+    batch_size : int
+        Triples per vectorized SGD update.
+    workers : int
+        Threads updating the shared factors concurrently.
+    item_features : sparse csr matrix, optional
+        Item x feature matrix on the same item index.
+    validation : sparse csr matrix, optional
+        Held out likes. precision@k on these is printed after every epoch.
+    k : int
+    seed : int, optional
+
+    Returns
+    -------
+    model : BPR
+    """
+    interactions = sp.csr_matrix(interactions, copy=True)
+    interactions.sum_duplicates()
+    interactions.sort_indices()
+    n_users, n_items = interactions.shape
+    # Users who like every item have no negatives to sample
+    full = np.diff(interactions.indptr) >= n_items
+    samples = interactions
+    if full.any():
+        print('Skipping {} users who like every item'.format(full.sum()))
+        samples = sp.diags((~full).astype(interactions.dtype)) @ interactions
+        samples = sp.csr_matrix(samples)
+        samples.eliminate_zeros()
+        samples.sort_indices()
+    if samples.nnz == 0:
+        raise ValueError('No interactions to train on')
+    rows = np.repeat(np.arange(n_users, dtype=np.int64),
+                     np.diff(samples.indptr))
+    keys = rows * n_items + samples.indices
+    model = BPR(n_users, n_items, factors=factors,
+                item_features=item_features, seed=seed)
+    if validation is not None:
+        eval_users = np.flatnonzero(np.diff(validation.indptr))
+    print('Training BPR on {} users x {} items, {} interactions, {} threads'
+          .format(n_users, n_items, interactions.nnz, workers))
+
+    seeds = np.random.SeedSequence(seed)
+    shard = -(-samples.nnz // workers)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for epoch in range(epochs):
+            t0 = time.time()
+            rngs = [np.random.default_rng(s) for s in seeds.spawn(workers)]
+            futures = [executor.submit(_hogwild_worker, model, samples,
+                                       keys, shard, batch_size,
+                                       learning_rate, regularization, rng)
+                       for rng in rngs]
+            loss = np.mean([future.result() for future in futures])
+            seconds = time.time() - t0
+            message = ('Epoch {}: loss {:.4f}, {:.0f} samples/second'
+                       .format(epoch + 1, loss,
+                               shard * workers / seconds))
+            if validation is not None:
+                message += ', precision@{} {:.4f}'.format(
+                    k, precision_at_k(model, interactions, validation, k,
+                                      eval_users))
+            print(message)
+    return model
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Train BPR (l2r) recs')
+    parser.add_argument('config', help='config file with data locations')
+    parser.add_argument('--factors', default=50, type=int)
+    parser.add_argument('--learning-rate', default=0.05, type=float)
+    parser.add_argument('--regularization', default=0.001, type=float)
+    parser.add_argument('--epochs', default=20, type=int)
+    parser.add_argument('--batch-size', default=1024, type=int)
+    parser.add_argument('--workers', default=1, type=int,
+                        help='Hogwild threads')
+    parser.add_argument('--features', action='store_true',
+                        help='Use categories and tags as item features')
+    parser.add_argument('--validation-count', default=0, type=int,
+                        help='Likes per user held out for precision@k. '
+                             'The final model is trained on all likes.')
+    parser.add_argument('--k', default=10, type=int)
+    parser.add_argument('--row-min', default=5, type=int,
+                        help='row_min for threshold_interactions_df')
+    parser.add_argument('--col-min', default=5, type=int,
+                        help='col_min for threshold_interactions_df')
+    parser.add_argument('--N', default=20, type=int,
+                        help='Number of recommendations per model')
+    parser.add_argument('--candidates', default=None, type=int,
+                        help='Candidates per model before dropping those '
+                             'without a thumbnail. Defaults to 3 * N.')
+    parser.add_argument('--output', default=None,
+                        help='Recs file. Defaults to the l2r file in config')
+    parser.add_argument('--seed', default=None, type=int)
+
+    args = parser.parse_args()
+    config = yaml.safe_load(open(args.config, 'r'))
+    likes_file = os.path.join(config['data_dir'],
+                              config['data_files']['likes_file'])
+    output = args.output or helpers.get_recs_filename(config, 'l2r')
+
+    interactions, uids, mids = helpers.load_interactions(
+        likes_file, args.row_min, args.col_min)
+    item_features = None
+    if args.features:
+        import content
+        features_file = os.path.join(
+            config['data_dir'], config['data_files']['model_features_file'])
+        item_features, _ = content.feature_matrix(
+            content.load_features(features_file), mids=mids)
+
+    options = dict(factors=args.factors, learning_rate=args.learning_rate,
+                   regularization=args.regularization, epochs=args.epochs,
+                   batch_size=args.batch_size, workers=args.workers,
+                   item_features=item_features, k=args.k, seed=args.seed)
+    if args.validation_count:
+        train_set, validation, _ = helpers.train_test_split(
+            interactions, args.validation_count, seed=args.seed)
+        print('Validation run')
+        train(train_set, validation=validation, **options)
+        print('Final run')
+    model = train(interactions, **options)
+
+    neighbours = helpers.factor_neighbours(model.item_embeddings(),
+                                           args.candidates or 3 * args.N)
+    helpers.export_recs(config, output, neighbours, mids, args.N)
+    print('Wrote recs to {}'.format(output))
@@ -0,0 +1,143 @@
+"""
+Item-to-item recommendations from the similarity of items' like vectors.
+
+Similarities are computed for one block of items at a time with a sparse
+matrix product against the full interactions matrix. Only the top K
+neighbours of each item are kept, so the item x item matrix is never held in
+memory. Blocks are spread across a process pool.
+"""
+
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import os
+
+import numpy as np
+import scipy.sparse as sp
+import yaml
+
+import helpers
+
+
+METRICS = ('cosine', 'jaccard')
+
+
+def _init_worker(item_user, user_item, metric, K):
+    """Store the read-only matrices once per worker process."""
+    global ITEM_USER, USER_ITEM, NORMS, METRIC, TOP_K
+    ITEM_USER = item_user
+    USER_ITEM = user_item
+    METRIC = metric
+    TOP_K = K
+    if metric == 'cosine':
+        NORMS = np.sqrt(np.asarray(item_user.multiply(item_user).sum(axis=1))
+                        .ravel())
+    else:
+        NORMS = np.diff(item_user.indptr).astype(np.float64)
+
+
+def block_similarity(item_user, user_item, norms, metric, start, stop):
+    """Dense similarity of items start:stop to every item."""
+    overlap = (item_user[start:stop] @ user_item).toarray()
+    if metric == 'cosine':
+        denom = norms[start:stop, np.newaxis] * norms[np.newaxis, :]
+    else:
+        denom = norms[start:stop, np.newaxis] + norms[np.newaxis, :] - overlap
+    return np.divide(overlap, denom, out=np.zeros_like(overlap),
+                     where=denom > 0)
+
+
+def block_neighbours(scores, start, K):
+    """Top K neighbours of a block of items, -1 where nothing is similar."""
+    scores[np.arange(scores.shape[0]), np.arange(start,
+                                                 start + scores.shape[0])] = 0.
+    neighbours = helpers.top_k(scores, K)
+    top_scores = np.take_along_axis(scores, neighbours, axis=1)
+    neighbours[top_scores <= 0] = -1
+    return neighbours.astype(np.int32)
+
+
+def _worker_block(start, stop):
+    scores = block_similarity(ITEM_USER, USER_ITEM, NORMS, METRIC, start, stop)
+    return start, block_neighbours(scores, start, TOP_K)
+
+
+def item_neighbours(interactions, K=20, metric='cosine', block_size=1024,
+                    workers=None):
+    """Top K most similar items for every item.
+
+    Parameters
+    ----------
+    interactions : sparse csr matrix
+        User x item interactions, e.g. from helpers.df_to_matrix.
+    K : int
+        Number of neighbours to keep per item.
+    metric : str
+        'cosine' or 'jaccard'. Jaccard treats interactions as binary.
+    block_size : int
+        Number of items scored per task. Each task holds a dense
+        block_size x n_items array of scores.
+    workers : int, optional
+        Number of worker processes.
+
+    Returns
+    -------
+    neighbours : array of int32 (n_items x K)
+        Item indices, most similar first, padded with -1.
+    """
+    if metric not in METRICS:
+        raise ValueError('Unknown metric {}'.format(metric))
+    user_item = sp.csr_matrix(interactions, dtype=np.float64)
+    if metric == 'jaccard':
+        user_item.data[:] = 1.
+    item_user = user_item.T.tocsr()
+    n_items = item_user.shape[0]
+    K = min(K, n_items - 1)
+
+    neighbours = np.empty((n_items, K), dtype=np.int32)
+    with ProcessPoolExecutor(max_workers=workers,
+                             initializer=_init_worker,
+                             initargs=(item_user, user_item, metric, K)) \
+            as executor:
+        futures = [executor.submit(_worker_block, start,
+                                   min(start + block_size, n_items))
+                   for start in range(0, n_items, block_size)]
+        for future in futures:
+            start, block = future.result()
+            neighbours[start:start + block.shape[0]] = block
+    return neighbours
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Item-item similarity recommendations')
+    parser.add_argument('config', help='config file with data locations')
+    parser.add_argument('--metric', default='cosine', choices=METRICS)
+    parser.add_argument('--N', default=20, type=int,
+                        help='Number of recommendations per model')
+    parser.add_argument('--candidates', default=None, type=int,
+                        help='Candidates per model before dropping those '
+                             'without a thumbnail. Defaults to 3 * N.')
+    parser.add_argument('--block-size', default=1024, type=int)
+    parser.add_argument('--workers', default=None, type=int)
+    parser.add_argument('--row-min', default=5, type=int,
+                        help='row_min for threshold_interactions_df')
+    parser.add_argument('--col-min', default=5, type=int,
+                        help='col_min for threshold_interactions_df')
+    parser.add_argument('--output', default=None,
+                        help='Recs file. Defaults to the tl file in config')
+
+    args = parser.parse_args()
+    config = yaml.safe_load(open(args.config, 'r'))
+    likes_file = os.path.join(config['data_dir'],
+                              config['data_files']['likes_file'])
+    output = args.output or helpers.get_recs_filename(config, 'tl')
+
+    interactions, uids, mids = helpers.load_interactions(
+        likes_file, args.row_min, args.col_min)
+    neighbours = item_neighbours(interactions,
+                                 K=args.candidates or 3 * args.N,
+                                 metric=args.metric,
+                                 block_size=args.block_size,
+                                 workers=args.workers)
+    helpers.export_recs(config, output, neighbours, mids, args.N)
+    print('Wrote recs to {}'.format(output))
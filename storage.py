@@ -0,0 +1,179 @@
+"""
+Columnar storage for crawl outputs and likes.
+
+Pipe-separated files are slow to parse and carry every column on every
+load. This module converts them to Parquet (optionally partitioned) or to an
+Arrow IPC file which can be memory-mapped, with string ID columns dictionary
+encoded, and reads back only the columns that are asked for. Loaders accept
+any of the three formats, so .psv files keep working.
+
+pyarrow is only needed for Parquet and Arrow files.
+
+    python storage.py convert data/model_likes.psv data/model_likes.parquet
+    python storage.py benchmark data/model_likes.psv --columns mid uid
+"""
+
+import argparse
+import csv
+import os
+import shutil
+import tempfile
+import time
+
+import pandas as pd
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+
+DICTIONARY_COLUMNS = ('mid', 'uid')
+ARROW_EXTENSIONS = ('.arrow', '.feather')
+
+
+def _require_pyarrow():
+    if pa is None:
+        raise ImportError('pyarrow is required for Parquet and Arrow files')
+
+
+def file_format(path):
+    """'parquet', 'arrow' or 'psv' based on path."""
+    if os.path.isdir(path) or path.endswith('.parquet'):
+        return 'parquet'
+    if path.endswith(ARROW_EXTENSIONS):
+        return 'arrow'
+    return 'psv'
+
+
+def read_psv(filename, columns=None, names=None):
+    """Read a pipe-separated file written by the crawlers."""
+    return pd.read_csv(filename, sep='|', quoting=csv.QUOTE_MINIMAL,
+                       quotechar='\\', usecols=columns, names=names,
+                       header=None if names else 'infer')
+
+
+def to_arrow_table(df, dictionary_columns=DICTIONARY_COLUMNS):
+    """Arrow table of df with ID columns dictionary encoded."""
+    _require_pyarrow()
+    df = df.copy()
+    for col in dictionary_columns:
+        if col in df:
+            df[col] = df[col].astype('category')
+    return pa.Table.from_pandas(df, preserve_index=False)
+
+
+def write_parquet(df, path, partition_cols=None,
+                  dictionary_columns=DICTIONARY_COLUMNS):
+    """Write df to a Parquet file, or a directory if partitioned."""
+    table = to_arrow_table(df, dictionary_columns)
+    if partition_cols:
+        pq.write_to_dataset(table, path, partition_cols=partition_cols)
+    else:
+        pq.write_table(table, path)
+
+
+def write_arrow(df, path, dictionary_columns=DICTIONARY_COLUMNS):
+    """Write df to an uncompressed Arrow IPC file suitable for mmap."""
+    table = to_arrow_table(df, dictionary_columns)
+    with pa.OSFile(path, 'wb') as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+
+
+def read_table(path, columns=None):
+    """Load columns of a psv, Parquet or Arrow file into a DataFrame.
+
+    Dictionary encoded columns come back as pandas categoricals.
+    """
+    fmt = file_format(path)
+    if fmt == 'psv':
+        return read_psv(path, columns=columns)
+    _require_pyarrow()
+    if fmt == 'parquet':
+        table = pq.read_table(path, columns=columns)
+    else:
+        with pa.memory_map(path, 'r') as source:
+            table = pa.ipc.open_file(source).read_all()
+        if columns is not None:
+            table = table.select(columns)
+    return table.to_pandas()
+
+
+def convert(psv_filename, out_path, names=None, partition_cols=None):
+    """One-shot conversion of a psv file to Parquet or Arrow."""
+    df = read_psv(psv_filename, names=names)
+    fmt = file_format(out_path)
+    if fmt == 'parquet':
+        write_parquet(df, out_path, partition_cols=partition_cols)
+    elif fmt == 'arrow':
+        write_arrow(df, out_path)
+    else:
+        raise ValueError('Output must end in .parquet, .arrow or .feather')
+    return df.shape[0]
+
+
+def disk_size(path):
+    if not os.path.isdir(path):
+        return os.path.getsize(path)
+    return sum(os.path.getsize(os.path.join(root, f))
+               for (root, _, files) in os.walk(path) for f in files)
+
+
+def benchmark(psv_filename, columns=None, names=None, repeats=3):
+    """Print load time and file size of psv vs Parquet vs Arrow."""
+    tmp_dir = tempfile.mkdtemp()
+    paths = [('psv', psv_filename),
+             ('parquet', os.path.join(tmp_dir, 'bench.parquet')),
+             ('arrow', os.path.join(tmp_dir, 'bench.arrow'))]
+    try:
+        for (_, path) in paths[1:]:
+            convert(psv_filename, path, names=names)
+        print('{:>8} | {:>10} | {:>10}'.format('format', 'MB', 'seconds'))
+        for (name, path) in paths:
+            t0 = time.time()
+            for _ in range(repeats):
+                if name == 'psv' and names:
+                    read_psv(path, columns=columns, names=names)
+                else:
+                    read_table(path, columns=columns)
+            seconds = (time.time() - t0) / repeats
+            print('{:>8} | {:>10.2f} | {:>10.3f}'.format(
+                name, disk_size(path) / 1024. ** 2, seconds))
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Columnar storage tools')
+    subparsers = parser.add_subparsers(dest='command')
+
+    convert_parser = subparsers.add_parser(
+        'convert', help='Convert a psv file to Parquet or Arrow')
+    convert_parser.add_argument('psv')
+    convert_parser.add_argument('out',
+                                help='.parquet, .arrow or .feather path')
+    convert_parser.add_argument('--names', nargs='+', default=None,
+                                help='Column names if the psv has no header')
+    convert_parser.add_argument('--partition-cols', nargs='+', default=None)
+
+    bench_parser = subparsers.add_parser(
+        'benchmark', help='Compare load time and size against the psv')
+    bench_parser.add_argument('psv')
+    bench_parser.add_argument('--columns', nargs='+', default=None)
+    bench_parser.add_argument('--names', nargs='+', default=None,
+                              help='Column names if the psv has no header')
+    bench_parser.add_argument('--repeats', default=3, type=int)
+
+    args = parser.parse_args()
+    if args.command == 'convert':
+        rows = convert(args.psv, args.out, names=args.names,
+                       partition_cols=args.partition_cols)
+        print('Wrote {} rows to {}'.format(rows, args.out))
+    elif args.command == 'benchmark':
+        benchmark(args.psv, columns=args.columns, names=args.names,
+                  repeats=args.repeats)
+    else:
+        parser.print_help()
@@ -0,0 +1,288 @@
+"""
+Hyperparameter sweeps for wrmf.py.
+
+Parsing the likes file, thresholding it and splitting it into train,
+validation and test sets only depends on the likes file and the row_min,
+col_min and split settings, so the prepared CSR matrices are cached on disk
+as .npy files under a hash of the file's content and those settings. Trials
+are run on a process pool and memory-map the cached arrays read-only, so all
+trials share one copy of each dataset through the page cache.
+
+Each trial evaluates precision@k on the validation set every --eval-every
+epochs and stops early once it has not improved for --patience evaluations.
+The factors of the best validation epoch are then evaluated once on the test
+set. Results are written to a csv file with one row per trial.
+
+    python sweep.py config.yml --factors 20 50 100 --alpha 10 40 \\
+        --row-min 5 10 --search random --trials 8
+"""
+
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import hashlib
+import itertools
+import json
+import os
+import time
+
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+import yaml
+
+import evaluate
+import helpers
+import wrmf
+
+
+DATA_PARAMS = ('row_min', 'col_min')
+MODEL_PARAMS = ('factors', 'regularization', 'alpha')
+
+
+def file_hash(filename, chunk_size=2 ** 20):
+    """sha256 of a file, or of every file under a directory."""
+    h = hashlib.sha256()
+    if os.path.isdir(filename):
+        paths = sorted(os.path.join(root, f)
+                       for (root, _, files) in os.walk(filename)
+                       for f in files)
+    else:
+        paths = [filename]
+    for path in paths:
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(chunk_size), b''):
+                h.update(chunk)
+    return h.hexdigest()
+
+
+def _save_csr(dirname, name, matrix):
+    for part in ('data', 'indices', 'indptr'):
+        np.save(os.path.join(dirname, '{}_{}.npy'.format(name, part)),
+                getattr(matrix, part))
+
+
+def _load_csr(dirname, name, shape):
+    parts = [np.load(os.path.join(dirname, '{}_{}.npy'.format(name, part)),
+                     mmap_mode='r')
+             for part in ('data', 'indices', 'indptr')]
+    return sp.csr_matrix(tuple(parts), shape=shape, copy=False)
+
+
+def prepare(likes_file, cache_dir, row_min, col_min, split_count=2,
+            fraction=None, seed=0, likes_hash=None):
+    """
+    Threshold and split the likes, or reuse a cached copy.
+
+    split_count likes of each user are held out for the test set, and
+    another split_count of the remaining ones for the validation set.
+
+    Returns
+    -------
+    dirname : str
+        Cache directory of the prepared data, for load_prepared.
+    """
+    params = {'likes': likes_hash or file_hash(likes_file),
+              'row_min': row_min, 'col_min': col_min,
+              'split_count': split_count, 'fraction': fraction, 'seed': seed,
+              'validation': True}
+    key = hashlib.sha256(json.dumps(params, sort_keys=True)
+                         .encode('utf-8')).hexdigest()[:16]
+    dirname = os.path.join(cache_dir, key)
+    if os.path.isfile(os.path.join(dirname, 'meta.json')):
+        print('Using cached data {} for row_min={} col_min={}'
+              .format(dirname, row_min, col_min))
+        return dirname
+
+    interactions, _, _ = helpers.load_interactions(likes_file, row_min,
+                                                   col_min)
+    rng = np.random.default_rng(seed)
+    train, test, user_index = helpers.train_test_split(
+        interactions, split_count, fraction=fraction, seed=rng)
+    train, validation, validation_index = helpers.train_test_split(
+        train, split_count, fraction=fraction, seed=rng)
+    tmp_dir = dirname + '.tmp'
+    os.makedirs(tmp_dir, exist_ok=True)
+    _save_csr(tmp_dir, 'train', sp.csr_matrix(train))
+    _save_csr(tmp_dir, 'validation', sp.csr_matrix(validation))
+    _save_csr(tmp_dir, 'test', sp.csr_matrix(test))
+    np.save(os.path.join(tmp_dir, 'validation_index.npy'), validation_index)
+    np.save(os.path.join(tmp_dir, 'user_index.npy'), user_index)
+    with open(os.path.join(tmp_dir, 'meta.json'), 'w') as f:
+        json.dump(dict(params, shape=list(interactions.shape)), f)
+    os.replace(tmp_dir, dirname)
+    return dirname
+
+
+def load_prepared(dirname):
+    """
+    Memory-mapped train, validation, test, validation_index and user_index
+    from prepare.
+    """
+    with open(os.path.join(dirname, 'meta.json'), 'r') as f:
+        shape = tuple(json.load(f)['shape'])
+    return (_load_csr(dirname, 'train', shape),
+            _load_csr(dirname, 'validation', shape),
+            _load_csr(dirname, 'test', shape),
+            np.load(os.path.join(dirname, 'validation_index.npy'),
+                    mmap_mode='r'),
+            np.load(os.path.join(dirname, 'user_index.npy'), mmap_mode='r'))
+
+
+def grid(space):
+    """Every combination of the values in space, a dict of lists."""
+    names = sorted(space)
+    return [dict(zip(names, values))
+            for values in itertools.product(*(space[n] for n in names))]
+
+
+def random_search(space, trials, seed=None):
+    """trials distinct combinations drawn at random from the grid."""
+    combinations = grid(space)
+    rng = np.random.default_rng(seed)
+    picks = rng.choice(len(combinations),
+                       size=min(trials, len(combinations)), replace=False)
+    return [combinations[i] for i in picks]
+
+
+def run_trial(dirname, params, epochs=15, eval_every=1, patience=2, k=10,
+              workers=1, seed=None):
+    """
+    Train WRMF on prepared data with early stopping on the validation set.
+
+    Returns
+    -------
+    result : dict
+        params, val_precision at the best validation epoch and the test
+        metrics of the factors from that epoch.
+    """
+    train, validation, test, validation_index, user_index = \
+        load_prepared(dirname)
+    history = []
+    best = {}
+
+    def callback(epoch, X, Y):
+        if epoch % eval_every and epoch != epochs:
+            return False
+        metrics = evaluate.evaluate(evaluate.FactorScorer(X, Y), train,
+                                    validation, validation_index, k=k,
+                                    workers=0)
+        metrics['epoch'] = epoch
+        history.append(metrics)
+        if not best or metrics['precision'] > best['precision']:
+            # X and Y are updated in place by the following epochs
+            best.update(metrics, index=len(history) - 1,
+                        factors=(X.copy(), Y.copy()))
+        return len(history) - 1 - best['index'] >= patience
+
+    t0 = time.time()
+    wrmf.train(train, factors=params['factors'],
+               regularization=params['regularization'],
+               alpha=params['alpha'], epochs=epochs, workers=workers,
+               seed=seed, callback=callback)
+    # Validation likes are known to the model's users as much as train ones
+    metrics = evaluate.evaluate(evaluate.FactorScorer(*best['factors']),
+                                train + validation, test, user_index, k=k,
+                                workers=0)
+    result = dict(params)
+    result['val_precision'] = best['precision']
+    result.update({metric: metrics[metric] for metric in evaluate.METRICS})
+    result['best_epoch'] = best['epoch']
+    result['epochs_run'] = history[-1]['epoch']
+    result['seconds'] = time.time() - t0
+    return result
+
+
+def sweep(likes_file, space, cache_dir, search='grid', trials=10,
+          split_count=2, fraction=None, epochs=15, eval_every=1, patience=2,
+          k=10, workers=None, trial_workers=1, seed=0):
+    """
+    Run WRMF trials over space and return their results, best validation
+    precision first.
+
+    space maps each of row_min, col_min, factors, regularization and alpha
+    to a list of values.
+    """
+    if search == 'grid':
+        settings = grid(space)
+    else:
+        settings = random_search(space, trials, seed=seed)
+    print('Running {} trials'.format(len(settings)))
+
+    likes_hash = file_hash(likes_file)
+    datasets = {}
+    for params in settings:
+        data_key = tuple(params[p] for p in DATA_PARAMS)
+        if data_key not in datasets:
+            datasets[data_key] = prepare(
+                likes_file, cache_dir, split_count=split_count,
+                fraction=fraction, seed=seed, likes_hash=likes_hash,
+                **{p: params[p] for p in DATA_PARAMS})
+
+    results = []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(run_trial,
+                                   datasets[tuple(params[p]
+                                                  for p in DATA_PARAMS)],
+                                   params, epochs=epochs,
+                                   eval_every=eval_every, patience=patience,
+                                   k=k, workers=trial_workers, seed=seed)
+                   for params in settings]
+        for future in futures:
+            result = future.result()
+            print('Trial done: ' + ', '.join(
+                '{}={}'.format(key, value) for (key, value) in
+                sorted(result.items())))
+            results.append(result)
+    results = pd.DataFrame(results)
+    columns = (list(DATA_PARAMS) + list(MODEL_PARAMS) + ['val_precision']
+               + list(evaluate.METRICS)
+               + ['best_epoch', 'epochs_run', 'seconds'])
+    return results[columns].sort_values('val_precision', ascending=False)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Hyperparameter sweep of wrmf.py')
+    parser.add_argument('config', help='config file with data locations')
+    parser.add_argument('--factors', nargs='+', default=[50], type=int)
+    parser.add_argument('--regularization', nargs='+', default=[0.01],
+                        type=float)
+    parser.add_argument('--alpha', nargs='+', default=[40.], type=float)
+    parser.add_argument('--row-min', nargs='+', default=[5], type=int)
+    parser.add_argument('--col-min', nargs='+', default=[5], type=int)
+    parser.add_argument('--search', default='grid',
+                        choices=['grid', 'random'])
+    parser.add_argument('--trials', default=10, type=int,
+                        help='Number of random search trials')
+    parser.add_argument('--epochs', default=15, type=int)
+    parser.add_argument('--eval-every', default=1, type=int)
+    parser.add_argument('--patience', default=2, type=int,
+                        help='Evaluations without improvement before a '
+                             'trial stops')
+    parser.add_argument('--k', default=10, type=int)
+    parser.add_argument('--split-count', default=2, type=int)
+    parser.add_argument('--fraction', default=None, type=float)
+    parser.add_argument('--workers', default=None, type=int,
+                        help='Trials run in parallel')
+    parser.add_argument('--trial-workers', default=1, type=int,
+                        help='ALS threads per trial')
+    parser.add_argument('--cache-dir', default='sweep_cache')
+    parser.add_argument('--output', default='sweep_results.csv')
+    parser.add_argument('--seed', default=0, type=int)
+
+    args = parser.parse_args()
+    config = yaml.safe_load(open(args.config, 'r'))
+    likes_file = os.path.join(config['data_dir'],
+                              config['data_files']['likes_file'])
+    space = {'factors': args.factors, 'regularization': args.regularization,
+             'alpha': args.alpha, 'row_min': args.row_min,
+             'col_min': args.col_min}
+    results = sweep(likes_file, space, args.cache_dir, search=args.search,
+                    trials=args.trials, split_count=args.split_count,
+                    fraction=args.fraction, epochs=args.epochs,
+                    eval_every=args.eval_every, patience=args.patience,
+                    k=args.k, workers=args.workers,
+                    trial_workers=args.trial_workers, seed=args.seed)
+    results.to_csv(args.output, index=False)
+    print(results.to_string(index=False))
+    print('Wrote results to {}'.format(args.output))
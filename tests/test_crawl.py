@@ -0,0 +1,290 @@
+import csv
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import queue
+import threading
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+
+import crawl
+
+
+BASE_MODEL_URL = 'https://sketchfab.test/models/'
+
+
+class FakeElement(object):
+
+    def __init__(self, text):
+        self.text = text
+
+
+class FakeBrowser(object):
+    """Just enough of a selenium driver for get_model_features."""
+
+    def __init__(self, pages):
+        self.pages = pages
+        self.page = None
+        self.quit_called = False
+
+    def get(self, url):
+        self.page = self.pages.get(url)
+
+    def execute_script(self, script):
+        assert script == 'return document.readyState'
+        return 'complete' if self.page is not None else 'loading'
+
+    def find_elements_by_xpath(self, xpath):
+        if self.page is None:
+            return []
+        if xpath == crawl.MODEL_META_XPATH:
+            return [FakeElement('meta')]
+        key = {crawl.CATEGORIES_XPATH: 'cats', crawl.TAGS_XPATH: 'tags'}
+        return [FakeElement(text) for text in self.page[key[xpath]]]
+
+    def quit(self):
+        self.quit_called = True
+
+
+PAGES = {
+    BASE_MODEL_URL + 'm1': {'cats': ['Animals'], 'tags': ['cat', 'cute']},
+    BASE_MODEL_URL + 'm2': {'cats': [], 'tags': []},
+}
+
+
+@pytest.fixture
+def catalog(tmp_path, monkeypatch):
+    monkeypatch.setattr(crawl, 'BASE_MODEL_URL', BASE_MODEL_URL,
+                        raising=False)
+    filename = str(tmp_path / 'urls.psv')
+    with open(filename, 'w') as f:
+        f.write('name|mid\nOne|m1\nTwo|m2\nBroken|m3\n')
+    return filename
+
+
+def make_factory(browsers):
+    def factory():
+        browser = FakeBrowser(PAGES)
+        browsers.append(browser)
+        return browser
+    return factory
+
+
+def read_rows(filename):
+    with open(filename, 'r') as f:
+        return list(csv.reader(f, delimiter='|', quotechar='\\'))
+
+
+def test_get_model_features_without_categories_or_tags():
+    browser = FakeBrowser(PAGES)
+    assert crawl.get_model_features(BASE_MODEL_URL + 'm2', browser,
+                                    timeout=1) == ([], [])
+
+
+def test_get_model_features_times_out():
+    with pytest.raises(Exception):
+        crawl.get_model_features(BASE_MODEL_URL + 'm3', FakeBrowser(PAGES),
+                                 timeout=0.1)
+
+
+def test_features_worker_retries_with_new_browser(monkeypatch):
+    monkeypatch.setattr(crawl, 'BASE_MODEL_URL', BASE_MODEL_URL,
+                        raising=False)
+    browsers = []
+    tasks, results = queue.Queue(), queue.Queue()
+    for mid in ['m3', 'm1', None]:
+        tasks.put(mid)
+    crawl.features_worker(make_factory(browsers), tasks, results, 0.1)
+
+    mid, cats, tags, error = results.get_nowait()
+    assert mid == 'm3' and error is not None
+    assert results.get_nowait() == ('m1', ['Animals'], ['cat', 'cute'], None)
+    assert len(browsers) == 2
+    assert all(browser.quit_called for browser in browsers)
+
+
+def test_crawl_model_features_checkpoints_and_resumes(catalog, tmp_path):
+    features = str(tmp_path / 'features.psv')
+    browsers = []
+    crawl.crawl_model_features(catalog, make_factory(browsers), features,
+                               workers=2, timeout=0.1)
+
+    rows = read_rows(features)
+    assert rows[0] == ['mid', 'type', 'value']
+    assert sorted(rows[1:]) == [['m1', 'category', 'Animals'],
+                                ['m1', 'tag', 'cat'], ['m1', 'tag', 'cute']]
+    with open(features + '.done') as f:
+        # m2 has no features but is done, m3 never loaded and is not
+        assert sorted(f.read().split()) == ['m1', 'm2']
+
+    # Only the failed model is tried again
+    PAGES[BASE_MODEL_URL + 'm3'] = {'cats': [], 'tags': ['late']}
+    try:
+        crawl.crawl_model_features(catalog, make_factory(browsers), features,
+                                   workers=2, timeout=0.1)
+    finally:
+        del PAGES[BASE_MODEL_URL + 'm3']
+    rows = read_rows(features)
+    assert rows.count(['mid', 'type', 'value']) == 1
+    assert len(rows) == 5 and rows[-1] == ['m3', 'tag', 'late']
+
+
+# Number of likes of each model served by LikesHandler. m5 always fails.
+LIKES = {'m1': 30, 'm2': 5, 'm3': 0, 'm4': 50}
+
+
+class LikesHandler(BaseHTTPRequestHandler):
+    """Pages of the likes API, failing the first request for m4."""
+
+    failed = set()
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        query = parse_qs(urlparse(self.path).query)
+        mid = query['model'][0]
+        offset = int(query['offset'][0])
+        count = int(query['count'][0])
+        if mid == 'm5' or (mid == 'm4' and mid not in self.failed):
+            self.failed.add(mid)
+            self.send_response(503)
+            self.end_headers()
+            return
+        n = LIKES[mid]
+        results = [{'username': 'user{}'.format(i), 'uid': 'uid{}'.format(i)}
+                   for i in range(offset, min(offset + count, n))]
+        body = json.dumps({'results': results,
+                           'next': 'more' if offset + count < n else None})
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.end_headers()
+        self.wfile.write(body.encode('utf-8'))
+
+
+@pytest.fixture
+def likes_server(monkeypatch):
+    LikesHandler.failed = set()
+    # Retries still happen, just without waiting
+    monkeypatch.setattr(crawl.fetch, 'backoff_sleep',
+                        lambda attempt, backoff: None)
+    server = ThreadingHTTPServer(('127.0.0.1', 0), LikesHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    monkeypatch.setattr(crawl, 'BASE_LIKES_URL',
+                        'http://127.0.0.1:{}/likes'.format(server.server_port),
+                        raising=False)
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def likes_catalog(tmp_path):
+    filename = str(tmp_path / 'urls.psv')
+    with open(filename, 'w') as f:
+        f.write('name|mid\n')
+        for mid in ['m1', 'm2', 'm3', 'm4', 'm5']:
+            f.write('Model {}|{}\n'.format(mid, mid))
+    return filename
+
+
+def likes_per_mid(filename):
+    counts = {}
+    for row in read_rows(filename):
+        counts[row[1]] = counts.get(row[1], 0) + 1
+    return counts
+
+
+def read_done(filename):
+    with open(filename + '.done') as f:
+        return sorted(f.read().split())
+
+
+def test_crawl_model_likes(likes_server, likes_catalog, tmp_path):
+    likes = str(tmp_path / 'likes.psv')
+    crawl.crawl_model_likes(likes_catalog, likes, concurrency=4,
+                            requests_per_second=1000)
+
+    assert likes_per_mid(likes) == {'m1': 30, 'm2': 5, 'm4': 50}
+    # m5 keeps failing, so it is left for the next run
+    assert read_done(likes) == ['m1', 'm2', 'm3', 'm4']
+
+
+def test_crawl_model_likes_resume_drops_unfinished(likes_server,
+                                                   likes_catalog, tmp_path):
+    likes = str(tmp_path / 'likes.psv')
+    crawl.crawl_model_likes(likes_catalog, likes, concurrency=4,
+                            requests_per_second=1000)
+    # Stopped after writing m2's likes again but before checkpointing it
+    with open(likes, 'a') as f:
+        f.write('Model m2|m2|user0|uid0\nModel m2|m2|user1|uid1\n')
+    with open(likes + '.done', 'w') as f:
+        f.write('m1\nm3\nm4\n')
+
+    crawl.crawl_model_likes(likes_catalog, likes, concurrency=4,
+                            requests_per_second=1000)
+
+    assert likes_per_mid(likes) == {'m1': 30, 'm2': 5, 'm4': 50}
+    assert read_done(likes) == ['m1', 'm2', 'm3', 'm4']
+
+
+class CatalogHandler(BaseHTTPRequestHandler):
+    """The model listing, 24 models per page, sorted by likes."""
+
+    models = []
+    requests = 0
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        CatalogHandler.requests += 1
+        query = parse_qs(urlparse(self.path).query)
+        offset = int(query.get('offset', ['0'])[0])
+        results = [{'name': name, 'uid': mid, 'likeCount': likes}
+                   for (name, mid, likes) in self.models[offset:offset + 24]]
+        next_url = None
+        if offset + 24 < len(self.models):
+            next_url = 'http://127.0.0.1:{}/api?offset={}'.format(
+                self.server.server_port, offset + 24)
+        body = json.dumps({'results': results, 'next': next_url})
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.end_headers()
+        self.wfile.write(body.encode('utf-8'))
+
+
+@pytest.fixture
+def catalog_server(monkeypatch):
+    CatalogHandler.models = [('Model {}'.format(i), 'm{}'.format(i), 200 - i)
+                             for i in range(200)]
+    CatalogHandler.requests = 0
+    server = ThreadingHTTPServer(('127.0.0.1', 0), CatalogHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    monkeypatch.setattr(crawl, 'CATALOG_API_URL',
+                        'http://127.0.0.1:{}/api'.format(server.server_port),
+                        raising=False)
+    monkeypatch.setattr(crawl, 'LIKE_LIMIT', 101, raising=False)
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_collect_model_urls_api_incremental(catalog_server, tmp_path):
+    urls = str(tmp_path / 'urls.psv')
+    crawl.collect_model_urls_api(urls, requests_per_second=0)
+    assert [mid for (_, mid) in crawl.read_catalog(urls)] == \
+        ['m{}'.format(i) for i in range(100)]
+    assert CatalogHandler.requests == 5
+
+    # Models new to the listing are appended wherever they rank, including
+    # one which only just reached LIKE_LIMIT
+    CatalogHandler.models.insert(3, ('New', 'new', 197))
+    CatalogHandler.models.insert(100, ('Deep', 'deep', 101))
+    crawl.collect_model_urls_api(urls, requests_per_second=0)
+    catalog = crawl.read_catalog(urls)
+    assert catalog[-2:] == [('New', 'new'), ('Deep', 'deep')]
+    assert len(catalog) == 102
+    assert len(set(catalog)) == 102
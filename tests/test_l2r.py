@@ -0,0 +1,45 @@
+import warnings
+
+import numpy as np
+import pytest
+import scipy.sparse as sp
+
+import l2r
+
+
+def test_train_skips_users_who_like_every_item():
+    interactions = sp.csr_matrix(np.array([[1, 1, 1, 1],
+                                           [1, 0, 0, 0],
+                                           [0, 1, 1, 0]], dtype=np.float64))
+    model = l2r.train(interactions, factors=4, epochs=2, batch_size=8,
+                      workers=2, seed=0)
+    assert model.user_factors.shape == (3, 4)
+
+
+@pytest.mark.parametrize('interactions', [sp.csr_matrix((3, 4)),
+                                          sp.csr_matrix(np.ones((2, 3)))])
+def test_train_without_negatives_raises(interactions):
+    with pytest.raises(ValueError):
+        l2r.train(interactions, epochs=1)
+
+
+def test_sample_triples_drops_triples_without_negatives():
+    interactions = sp.csr_matrix(np.array([[1, 1, 1], [1, 0, 0]],
+                                          dtype=np.float64))
+    keys = np.array([0, 1, 2, 3], dtype=np.int64)
+    users, positives, negatives = l2r.sample_triples(
+        interactions, keys, 50, np.random.default_rng(0), max_redraws=5)
+    assert users.size and (users == 1).all()
+    assert (positives == 0).all() and (negatives != 0).all()
+
+
+def test_hogwild_worker_skips_empty_batches():
+    # No negative can ever be drawn, so every batch comes back empty
+    only_full = sp.csr_matrix(np.ones((1, 3)))
+    keys = np.array([0, 1, 2], dtype=np.int64)
+    model = l2r.BPR(1, 3, factors=2, seed=0)
+    with warnings.catch_warnings():
+        warnings.simplefilter('error')
+        loss = l2r._hogwild_worker(model, only_full, keys, 16, 4, 0.05,
+                                   0.001, np.random.default_rng(0))
+    assert loss == 0.
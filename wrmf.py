@@ -0,0 +1,284 @@
+"""
+Train implicit feedback weighted matrix factorization (WRMF) with alternating
+least squares and write item-to-item recommendations for the flask app.
+
+Each ALS half-step solves for one side's factors with a few steps of the
+conjugate gradient method, warm started from the previous epoch (see Takacs
+et al., "Applications of the Conjugate Gradient Method for Implicit Feedback
+Collaborative Filtering"). Users (or items) are solved in blocks: every CG
+step for a whole block is a handful of dense and sparse matrix products, and
+blocks are spread across a thread pool.
+"""
+
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import json
+import os
+import resource
+import time
+
+import numpy as np
+import scipy.sparse as sp
+import yaml
+
+import helpers
+
+
+def peak_memory_mb():
+    """Peak resident memory of this process in MB."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+
+def conjugate_gradient(Cb, x, Y, YtY, regularization, cg_steps):
+    """Update a block of factors in place with conjugate gradient steps.
+
+    Approximately solves
+
+        (YtY + Yt (C_u - I) Y + regularization * I) x_u = Yt C_u p_u
+
+    for every row u of the block at once.
+
+    Parameters
+    ----------
+    Cb : sparse csr matrix
+        Confidence (1 + alpha * r_ui) for the block's rows.
+    x : array
+        The block's current factors. Updated in place.
+    Y : array
+        Fixed factors of the other side.
+    YtY : array
+        Precomputed Y.T @ Y.
+    regularization : float
+    cg_steps : int
+    """
+    rows = np.repeat(np.arange(Cb.shape[0]), np.diff(Cb.indptr))
+    Y_nz = Y[Cb.indices]
+    weights = Cb.data - 1.
+
+    def matvec(p):
+        dots = np.einsum('ij,ij->i', p[rows], Y_nz) * weights
+        D = sp.csr_matrix((dots, Cb.indices, Cb.indptr), shape=Cb.shape)
+        return p @ YtY + regularization * p + D @ Y
+
+    # p_ui is 1 wherever c_ui is stored, so Yt C_u p_u is just Cb @ Y
+    r = Cb @ Y - matvec(x)
+    p = r.copy()
+    rsold = np.einsum('ij,ij->i', r, r)
+    for _ in range(cg_steps):
+        Ap = matvec(p)
+        denom = np.einsum('ij,ij->i', p, Ap)
+        alpha = np.divide(rsold, denom, out=np.zeros_like(rsold),
+                          where=denom > 0)
+        x += alpha[:, np.newaxis] * p
+        r -= alpha[:, np.newaxis] * Ap
+        rsnew = np.einsum('ij,ij->i', r, r)
+        beta = np.divide(rsnew, rsold, out=np.zeros_like(rsnew),
+                         where=rsold > 0)
+        p = r + beta[:, np.newaxis] * p
+        rsold = rsnew
+
+
+def als_step(executor, C, X, Y, regularization, cg_steps, block_size):
+    """Solve for every row of X with Y held fixed."""
+    YtY = Y.T @ Y
+    futures = []
+    for start in range(0, X.shape[0], block_size):
+        stop = min(start + block_size, X.shape[0])
+        futures.append(executor.submit(conjugate_gradient, C[start:stop],
+                                       X[start:stop], Y, YtY,
+                                       regularization, cg_steps))
+    for future in futures:
+        future.result()
+
+
+def train(interactions, factors=50, regularization=0.01, alpha=40.,
+          epochs=15, cg_steps=3, block_size=2048, workers=None, seed=None,
+          callback=None):
+    """Fit WRMF to an implicit feedback matrix.
+
+    Parameters
+    ----------
+    interactions : sparse csr matrix
+        User x item interactions, e.g. from helpers.df_to_matrix.
+    factors : int
+        Number of latent factors.
+    regularization : float
+        L2 penalty on the factors.
+    alpha : float
+        Confidence scaling: c_ui = 1 + alpha * r_ui.
+    epochs : int
+        Number of full ALS passes over users and items.
+    cg_steps : int
+        Conjugate gradient steps per ALS half-step.
+    block_size : int
+        Number of users (or items) solved together in one task.
+    workers : int, optional
+        Size of the thread pool. Defaults to the executor's default.
+    seed : int, optional
+        Seed for the factor initialization.
+    callback : callable, optional
+        Called as callback(epoch, X, Y) after every epoch. Training stops
+        early if it returns True.
+
+    Returns
+    -------
+    user_factors : array (n_users x factors)
+    item_factors : array (n_items x factors)
+    """
+    rng = np.random.default_rng(seed)
+    Cui = interactions.tocsr().astype(np.float32)
+    Cui.data = 1. + alpha * Cui.data
+    Ciu = Cui.T.tocsr()
+
+    n_users, n_items = Cui.shape
+    X = rng.normal(scale=0.01, size=(n_users, factors)).astype(np.float32)
+    Y = rng.normal(scale=0.01, size=(n_items, factors)).astype(np.float32)
+    print('Training WRMF on {} users x {} items, {} interactions'
+          .format(n_users, n_items, Cui.nnz))
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for epoch in range(epochs):
+            t0 = time.time()
+            als_step(executor, Cui, X, Y, regularization, cg_steps,
+                     block_size)
+            als_step(executor, Ciu, Y, X, regularization, cg_steps,
+                     block_size)
+            print('Epoch {}: {:.2f} seconds, peak memory {:.1f} MB'
+                  .format(epoch + 1, time.time() - t0, peak_memory_mb()))
+            if callback is not None and callback(epoch + 1, X, Y):
+                break
+    return X, Y
+
+
+def solve_rows(C, Y, regularization, rows, block_size=2048):
+    """Exact ALS solution for the given rows of X with Y held fixed.
+
+    Used to fold new or changed users (or items) into a trained model.
+
+    Parameters
+    ----------
+    C : sparse csr matrix
+        Confidence (1 + alpha * r_ui) for every row.
+    Y : array
+        Fixed factors of the other side.
+    regularization : float
+    rows : array of int
+    block_size : int
+        Rows whose normal equations are solved together.
+
+    Returns
+    -------
+    X_rows : array (len(rows) x factors)
+    """
+    factors = Y.shape[1]
+    base = Y.T @ Y + regularization * np.eye(factors, dtype=Y.dtype)
+    X_rows = np.empty((len(rows), factors), dtype=Y.dtype)
+    for start in range(0, len(rows), block_size):
+        Cb = C[rows[start:start + block_size]]
+        A = np.repeat(base[np.newaxis], Cb.shape[0], axis=0)
+        for i in range(Cb.shape[0]):
+            nz = slice(Cb.indptr[i], Cb.indptr[i + 1])
+            Y_nz = Y[Cb.indices[nz]]
+            A[i] += (Y_nz.T * (Cb.data[nz] - 1.)) @ Y_nz
+        b = Cb @ Y
+        X_rows[start:start + Cb.shape[0]] = np.linalg.solve(
+            A, b[:, :, np.newaxis])[:, :, 0]
+    return X_rows
+
+
+def save_model(dirname, user_factors, item_factors, uids, mids,
+               interactions=None, params=None):
+    """Save factors and id mappings as .npy files in dirname.
+
+    The interactions the model was trained on and the training
+    hyperparameters (e.g. alpha and regularization) are needed by
+    incremental.py. They are saved as interactions.npz and params.json if
+    given.
+    """
+    if not os.path.isdir(dirname):
+        os.makedirs(dirname)
+    np.save(os.path.join(dirname, 'user_factors.npy'), user_factors)
+    np.save(os.path.join(dirname, 'item_factors.npy'), item_factors)
+    np.save(os.path.join(dirname, 'uids.npy'), np.asarray(uids).astype(str))
+    np.save(os.path.join(dirname, 'mids.npy'), np.asarray(mids).astype(str))
+    if interactions is not None:
+        sp.save_npz(os.path.join(dirname, 'interactions.npz'),
+                    sp.csr_matrix(interactions))
+    if params is not None:
+        with open(os.path.join(dirname, 'params.json'), 'w') as f:
+            json.dump(params, f)
+
+
+def load_model(dirname):
+    """Load the output of save_model.
+
+    Returns
+    -------
+    user_factors, item_factors, uids, mids : arrays
+    """
+    return tuple(np.load(os.path.join(dirname, name + '.npy'))
+                 for name in ('user_factors', 'item_factors', 'uids', 'mids'))
+
+
+def load_params(dirname):
+    """Training hyperparameters saved by save_model, or {} if none were."""
+    filename = os.path.join(dirname, 'params.json')
+    if not os.path.isfile(filename):
+        return {}
+    with open(filename, 'r') as f:
+        return json.load(f)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Train WRMF recommendations')
+    parser.add_argument('config', help='config file with data locations')
+    parser.add_argument('--factors', default=50, type=int)
+    parser.add_argument('--regularization', default=0.01, type=float)
+    parser.add_argument('--alpha', default=40., type=float,
+                        help='Confidence scaling of likes')
+    parser.add_argument('--epochs', default=15, type=int)
+    parser.add_argument('--cg-steps', default=3, type=int)
+    parser.add_argument('--workers', default=None, type=int)
+    parser.add_argument('--row-min', default=5, type=int,
+                        help='row_min for threshold_interactions_df')
+    parser.add_argument('--col-min', default=5, type=int,
+                        help='col_min for threshold_interactions_df')
+    parser.add_argument('--N', default=20, type=int,
+                        help='Number of recommendations per model')
+    parser.add_argument('--candidates', default=None, type=int,
+                        help='Candidates per model before dropping those '
+                             'without a thumbnail. Defaults to 3 * N.')
+    parser.add_argument('--output', default=None,
+                        help='Recs file. Defaults to the wrmf file in config')
+    parser.add_argument('--model-dir', default=None,
+                        help='Also save factors here, e.g. for ann.py')
+    parser.add_argument('--seed', default=None, type=int)
+
+    args = parser.parse_args()
+    config = yaml.safe_load(open(args.config, 'r'))
+    likes_file = os.path.join(config['data_dir'],
+                              config['data_files']['likes_file'])
+    output = args.output or helpers.get_recs_filename(config, 'wrmf')
+
+    interactions, uids, mids = helpers.load_interactions(
+        likes_file, args.row_min, args.col_min)
+    user_factors, item_factors = train(interactions,
+                                       factors=args.factors,
+                                       regularization=args.regularization,
+                                       alpha=args.alpha,
+                                       epochs=args.epochs,
+                                       cg_steps=args.cg_steps,
+                                       workers=args.workers,
+                                       seed=args.seed)
+    if args.model_dir:
+        save_model(args.model_dir, user_factors, item_factors, uids, mids,
+                   interactions=interactions,
+                   params={'factors': args.factors,
+                           'regularization': args.regularization,
+                           'alpha': args.alpha})
+    neighbours = helpers.factor_neighbours(item_factors,
+                                           args.candidates or 3 * args.N)
+    if args.model_dir:
+        np.save(os.path.join(args.model_dir, 'neighbours.npy'), neighbours)
+    helpers.export_recs(config, output, neighbours, mids, args.N)
+    print('Wrote recs to {}'.format(output))